@@ -0,0 +1,265 @@
+# Boson Sampling Library - A library to help better understand Aaronson-Arkhipov Boson Sampling (AABS)
+# Copyright (C) 2021  If and Only If (Iff) Technologies
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+## Program Description:
+
+# Times the hot paths of `bosonsampling` (submatrix construction,
+# single output probabilities, output configuration enumeration and
+# full output distributions) across photon and mode counts, for both
+# AABS style single photon inputs and bunched inputs.
+#
+# Run from the repository root:
+#
+#   python benchmarks/run.py --output results.json
+#
+# and compare a later run against a stored baseline with:
+#
+#   python benchmarks/run.py --compare results.json
+#
+# which exits with a non-zero status if any case got slower by more
+# than `--threshold`.
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import scipy as sp
+from scipy.stats import unitary_group
+
+# Benchmark the working tree rather than an installed copy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bosonsampling as bs  # noqa: E402
+
+
+def time_call(func, min_time):
+    """Time a function, repeating it until `min_time` seconds have
+    passed.
+
+    Args:
+        func (callable):
+            The function to time, called without arguments
+        min_time (float):
+            The minimum total time spent calling `func`
+
+    Returns:
+        float: The fastest observed time of a single call in seconds
+    """
+
+    func()  # warm up (e.g. numba compilation inside thewalrus)
+
+    best = float("inf")
+    total = 0.0
+    while total < min_time:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+
+    return best
+
+
+def gen_photons_in(num_photons, num_modes, kind):
+    """Build the input configuration of a benchmark case.
+
+    Args:
+        num_photons (int):
+            The total number of photons
+        num_modes (int):
+            The total number of modes
+        kind (str):
+            "aabs" for one photon in each of the first modes, "bunched"
+            for two photons in each of the first modes
+
+    Returns:
+        [int]: The input photon configuration
+    """
+
+    photons_in = np.zeros(num_modes, dtype=np.intp)
+    if kind == "aabs":
+        photons_in[:num_photons] = 1
+    else:
+        photons_in[:num_photons // 2] = 2
+        photons_in[num_photons // 2] += num_photons % 2
+
+    return photons_in.tolist()
+
+
+def gen_cases(max_photons, max_modes):
+    """Generate the (photons, modes, input kind) combinations to time.
+
+    Args:
+        max_photons (int):
+            The largest number of photons
+        max_modes (int):
+            The largest number of modes
+
+    Yields:
+        (int, int, str): A benchmark case
+    """
+
+    for num_photons in range(1, max_photons + 1):
+        modes = {num_photons, 2 * num_photons, 4 * num_photons,
+                 num_photons**2, max_modes}
+        for num_modes in sorted(m for m in modes
+                                if num_photons <= m <= max_modes):
+            for kind in ("aabs", "bunched"):
+                if kind == "bunched" and num_photons < 2:
+                    continue
+                yield num_photons, num_modes, kind
+
+
+def run(max_photons, max_modes, max_configurations, min_time, seed):
+    """Time every hot path for every benchmark case.
+
+    Args:
+        max_photons (int):
+            The largest number of photons
+        max_modes (int):
+            The largest number of modes
+        max_configurations (int):
+            Enumeration and full distributions are only timed when the
+            number of output configurations (times 2^photons for
+            distributions) stays below this bound
+        min_time (float):
+            The minimum time spent on each timing
+        seed (int):
+            Seed of the random unitaries and output configurations
+
+    Returns:
+        [dict]: One result per timed (function, case) pair
+    """
+
+    rng = np.random.default_rng(seed)
+    results = []
+
+    for num_photons, num_modes, kind in gen_cases(max_photons, max_modes):
+        unitary_mat = unitary_group.rvs(num_modes, random_state=rng)
+        photons_in = gen_photons_in(num_photons, num_modes, kind)
+        num_configurations = bs.num_output_configurations(num_photons,
+                                                          num_modes)
+        photons_out = bs.unrank_configuration(
+            int(rng.integers(num_configurations)), num_photons,
+            num_modes).tolist()
+
+        timings = {
+            "gen_submatrix": lambda: bs.gen_submatrix(photons_in, photons_out,
+                                                      unitary_mat),
+            "output_probability": lambda: bs.output_probability(
+                photons_in, photons_out, unitary_mat),
+        }
+        if num_configurations <= max_configurations:
+            timings["gen_output_configurations"] = lambda: sum(
+                1 for _ in bs.gen_output_configurations(num_photons,
+                                                        num_modes))
+        if num_configurations * 2**num_photons <= max_configurations:
+            timings["output_distribution"] = lambda: bs.output_distribution(
+                photons_in, unitary_mat)
+
+        for name, func in timings.items():
+            seconds = time_call(func, min_time)
+            results.append({"name": name, "input": kind,
+                            "photons": num_photons, "modes": num_modes,
+                            "seconds": seconds})
+            print("{0:<26} {1:<8} n={2:<3} m={3:<4} {4:.3e} s"
+                  .format(name, kind, num_photons, num_modes, seconds))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compare results against a baseline run.
+
+    Args:
+        results ([dict]):
+            The results of this run
+        baseline ([dict]):
+            The results of the baseline run
+        threshold (float):
+            The relative slowdown above which a case counts as a
+            regression, e.g. 0.25 for 25%
+
+    Returns:
+        [(dict, float)]: Every regressed result and its slowdown ratio
+    """
+
+    def key(result):
+        return (result["name"], result["input"], result["photons"],
+                result["modes"])
+
+    baseline = {key(result): result["seconds"] for result in baseline}
+
+    regressions = []
+    for result in results:
+        if key(result) in baseline:
+            ratio = result["seconds"] / baseline[key(result)]
+            if ratio > 1 + threshold:
+                regressions.append((result, ratio))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the hot paths of bosonsampling and optionally "
+                    "compare against a stored baseline.")
+    parser.add_argument("--max-photons", type=int, default=20)
+    parser.add_argument("--max-modes", type=int, default=100)
+    parser.add_argument("--max-configurations", type=int, default=10**6,
+                        help="bound on the work of enumeration and full "
+                             "distribution cases")
+    parser.add_argument("--min-time", type=float, default=0.05,
+                        help="minimum seconds spent timing each case")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare "
+                                          "against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="relative slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    results = run(args.max_photons, args.max_modes, args.max_configurations,
+                  args.min_time, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"meta": {"python": platform.python_version(),
+                                "numpy": np.__version__,
+                                "scipy": sp.__version__,
+                                "platform": platform.platform(),
+                                "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+                       "results": results}, output_file, indent=4)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for result, ratio in regressions:
+            print("REGRESSION {0} {1} n={2} m={3}: {4:.2f}x slower"
+                  .format(result["name"], result["input"], result["photons"],
+                          result["modes"], ratio))
+        if regressions:
+            sys.exit(1)
+        print("No regressions above {0:.0%}".format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
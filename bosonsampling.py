@@ -14,13 +14,249 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numba
 import numpy as np
 import scipy as sp
 import thewalrus
-from sympy.utilities.iterables import multiset_permutations
 
 
-def gen_submatrix(photons_in, photons_out, unitary_mat):
+# Fixed cost of a `_multiplicity_permanent` call in units of one inner
+# operation of a compiled full permanent (about 4 ns with thewalrus),
+# measured along with the per-term cost, see `_use_multiplicities`
+_MULTIPLICITY_CALL_COST = 1 << 16
+
+# Maximum number of submatrices stacked at once by the batched
+# probability functions
+_BATCH_SIZE = 4096
+
+# Maximum size in bytes of the row sum table the vectorized Ryser and
+# Glynn kernels hold at once (batch x 2^low columns x rows)
+_ROW_SUM_BYTES = 1 << 26
+
+# Number of matrices the single precision Glynn kernel walks the Gray
+# code for at once, so their row sums stay in cache
+_SINGLE_LANES = 256
+
+# Maximum number of configurations looked up per SQLite query of a
+# `ProbabilityCache` (older SQLite builds allow 999 parameters)
+_SQLITE_CHUNK = 900
+
+# Result of a calculation that may be estimated, exact results have a
+# standard error of zero and a zero-width interval
+Estimate = collections.namedtuple("Estimate", ["value", "stderr", "low",
+                                               "high"])
+
+# Complex dtypes of the `precision` options. Long double is 80-bit
+# extended precision on x86 (and no wider than double on some
+# platforms, e.g. Windows or ARM macOS).
+_PRECISIONS = {
+    "single": np.csingle,
+    "double": np.cdouble,
+    "extended": np.clongdouble,
+}
+
+
+# Statistics collected while a `profile()` block is active, None when
+# instrumentation is disabled
+_stats = None
+
+
+class ProfileStats:
+    """Call counts, wall times and permanent matrix sizes recorded by
+    the instrumented stages of the library inside a `profile()` block.
+
+    Memory stays bounded however many sections are recorded: every
+    stage keeps its section count and total time, and percentiles are
+    taken from a uniform sample (reservoir) of its section times.
+
+    Args:
+        reservoir (int, optional):
+            The maximum number of section times kept per stage.
+            Defaults to 4096.
+
+    Attributes:
+        calls (collections.Counter):
+            The number of calls (or generated configurations) per stage
+        sections (collections.Counter):
+            The number of timed sections per stage
+        totals (collections.Counter):
+            The total wall time in seconds per stage
+        timings (dict):
+            A uniform sample of at most `reservoir` recorded wall times
+            in seconds per stage
+        matrix_sizes (collections.Counter):
+            The number of matrices handed to the permanent backend per
+            matrix size
+    """
+
+    def __init__(self, reservoir=4096):
+        self.reservoir = reservoir
+        self.calls = collections.Counter()
+        self.sections = collections.Counter()
+        self.totals = collections.Counter()
+        self.timings = collections.defaultdict(list)
+        self.matrix_sizes = collections.Counter()
+        self._random = random.Random()
+
+    def record(self, stage, seconds, calls=1):
+        """Record the wall time of one timed section of a stage.
+
+        Args:
+            stage (str):
+                The name of the stage
+            seconds (float):
+                The wall time of the section
+            calls (int, optional):
+                The number of calls the section covers. Defaults to 1.
+        """
+
+        self.calls[stage] += calls
+        self.sections[stage] += 1
+        self.totals[stage] += seconds
+
+        # Reservoir sampling keeps every section with equal probability
+        timings = self.timings[stage]
+        if len(timings) < self.reservoir:
+            timings.append(seconds)
+        else:
+            slot = self._random.randrange(self.sections[stage])
+            if slot < self.reservoir:
+                timings[slot] = seconds
+
+    def summary(self):
+        """Summarize the recorded statistics.
+
+        Returns:
+            dict:
+                For every stage its call count and the total, mean,
+                median, 90th and 99th percentile wall time of its
+                recorded sections (percentiles estimated from the
+                sampled sections), plus the permanent matrix size
+                histogram under "matrix_sizes"
+        """
+
+        summary = {}
+        for stage, timings in self.timings.items():
+            p50, p90, p99 = np.percentile(timings, [50, 90, 99])
+            summary[stage] = {"calls": self.calls[stage],
+                              "total": self.totals[stage],
+                              "mean": (self.totals[stage] /
+                                       self.sections[stage]),
+                              "p50": p50, "p90": p90, "p99": p99}
+        summary["matrix_sizes"] = dict(sorted(self.matrix_sizes.items()))
+
+        return summary
+
+    def report(self):
+        """Format the summary as a table, slowest stage first.
+
+        Returns:
+            str: The formatted report
+        """
+
+        summary = self.summary()
+        matrix_sizes = summary.pop("matrix_sizes")
+        lines = ["{0:<48} {1:>10} {2:>11} {3:>11} {4:>11} {5:>11}".format(
+            "stage", "calls", "total (s)", "p50 (s)", "p90 (s)", "p99 (s)")]
+        for stage, row in sorted(summary.items(),
+                                 key=lambda item: -item[1]["total"]):
+            lines.append("{0:<48} {1:>10} {2:>11.3e} {3:>11.3e} {4:>11.3e} "
+                         "{5:>11.3e}".format(stage, row["calls"],
+                                             row["total"], row["p50"],
+                                             row["p90"], row["p99"]))
+        lines.append("permanent matrix sizes: {0}".format(matrix_sizes))
+
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def profile():
+    """Context manager recording per stage call counts and wall times of
+    `gen_submatrix`, `gen_submatrices`, `output_probability`,
+    `batch_output_probability` and `gen_output_configurations` (including
+    their permanent and normalization stages), plus the sizes of the
+    matrices handed to the permanent backend.
+
+    Instrumentation is off outside of a `profile()` block, costing only
+    a check of a module level variable per stage.
+
+    Yields:
+        ProfileStats: The statistics recorded inside the block
+    """
+
+    global _stats
+
+    previous = _stats
+    _stats = ProfileStats()
+    try:
+        yield _stats
+    finally:
+        _stats = previous
+
+
+def _timer():
+    """Start timing an instrumented stage.
+
+    Returns:
+        float: The current time if instrumentation is enabled, else 0
+    """
+
+    return time.perf_counter() if _stats is not None else 0.0
+
+
+def _record(stage, start, calls=1):
+    """Finish timing an instrumented stage started with `_timer`.
+
+    Args:
+        stage (str):
+            The name of the stage
+        start (float):
+            The value returned by `_timer`
+        calls (int, optional):
+            The number of calls the timed section covers. Defaults to 1.
+    """
+
+    if _stats is not None:
+        _stats.record(stage, time.perf_counter() - start, calls)
+
+
+def _precision_dtype(precision):
+    """Look up the complex dtype of a `precision` option.
+
+    Args:
+        precision (str):
+            "single", "double" or "extended"
+
+    Raises:
+        ValueError:
+            If the precision is unknown, a ValueError is raised.
+
+    Returns:
+        type: The complex NumPy dtype
+    """
+
+    if precision not in _PRECISIONS:
+        raise ValueError("Unknown precision {0}!".format(precision))
+
+    return _PRECISIONS[precision]
+
+
+def gen_submatrix(photons_in, photons_out, unitary_mat, precision="double"):
     """Generates a submatrix from a given unitary matrix representing
     a linear interferometer whose permanent can be used to calculate
     photon output configuration probabilities.
@@ -36,6 +272,9 @@ def gen_submatrix(photons_in, photons_out, unitary_mat):
             interferometer
         unitary_mat (np.array):
             A unitary matrix describing an interferometer
+        precision (str, optional):
+            The floating point precision of the submatrix, "single",
+            "double" or "extended". Defaults to "double".
 
     Raises:
         ValueError:
@@ -48,6 +287,9 @@ def gen_submatrix(photons_in, photons_out, unitary_mat):
             argument
     """
 
+    start = _timer()
+    dtype = _precision_dtype(precision)
+
     if sum(photons_in) != sum(photons_out):
         raise ValueError("Number of photons inputted is not equal"
                          "to number outputted!")
@@ -57,8 +299,7 @@ def gen_submatrix(photons_in, photons_out, unitary_mat):
     # Generate a matrix consisting solely of columns from the main
     # unitary matrix. Row dimension is preserved but the number of
     # columns is equal to the number of photons.
-    col_mat = np.zeros((unitary_mat.shape[0], photon_count),
-                       dtype=np.cdouble)
+    col_mat = np.zeros((unitary_mat.shape[0], photon_count), dtype=dtype)
 
     # Obtain columns for `col_mat`, based on the input photon
     # configuration.
@@ -74,7 +315,7 @@ def gen_submatrix(photons_in, photons_out, unitary_mat):
 
     # Create the final submatrix, which should be (number of photons in
     # x number of photons out) large
-    sub_mat = np.zeros((photon_count, photon_count), dtype=np.cdouble)
+    sub_mat = np.zeros((photon_count, photon_count), dtype=dtype)
 
     # Looking at the output photon configuration, rows from `col_mat`
     # are indexed and added to the final submatrix.
@@ -87,9 +328,90 @@ def gen_submatrix(photons_in, photons_out, unitary_mat):
             sub_mat[row_idx, :] = col_mat[row, :]
             row_idx += 1
 
+    _record("gen_submatrix", start)
+
     return sub_mat
 
 
+def _photon_indices(photons):
+    """Convert a photon configuration into the mode index of every
+    individual photon, e.g. [1,2,0,0] becomes [0,1,1].
+
+    Args:
+        photons ([int]):
+            A list with each integer entry representing the number
+            of individual photons in each mode
+
+    Returns:
+        np.array:
+            A 1-D integer array with one (sorted) mode index per photon
+    """
+
+    photons = np.asarray(photons, dtype=np.intp)
+
+    return np.repeat(np.arange(photons.shape[-1]), photons)
+
+
+def gen_submatrices(photons_in, photons_out, unitary_mat, precision="double"):
+    """A batched version of `gen_submatrix` that builds the submatrices
+    for many output configurations (sharing one input configuration)
+    at once using index arrays instead of Python loops.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        photons_out (np.array):
+            A 2-D array with one output configuration per row, each
+            integer entry representing the number of individual photons
+            at the output modes for the interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        precision (str, optional):
+            The floating point precision of the submatrices, "single",
+            "double" or "extended". Defaults to "double".
+
+    Raises:
+        ValueError:
+            If the number of photons inputted do not equal the number
+            of photons output for every row of `photons_out`, a
+            ValueError is raised.
+
+    Returns:
+        np.array:
+            A (batch x photons x photons) array where entry `i` is the
+            submatrix `gen_submatrix` would build for `photons_out[i]`
+    """
+
+    start = _timer()
+    photons_out = np.atleast_2d(np.asarray(photons_out, dtype=np.intp))
+    col_idx = _photon_indices(photons_in)
+    photon_count = col_idx.shape[0]
+
+    if np.any(photons_out.sum(axis=1) != photon_count):
+        raise ValueError("Number of photons inputted is not equal "
+                         "to number outputted!")
+
+    # The column gather only depends on the input configuration, so
+    # it is done once and shared by every output configuration
+    col_mat = np.asarray(unitary_mat, dtype=_precision_dtype(precision))[
+        :, col_idx]
+
+    # Every row of `photons_out` holds the same number of photons, so
+    # repeating the mode indices of the flattened batch by the photon
+    # counts gives exactly `photon_count` row indices per configuration
+    batch, num_modes = photons_out.shape
+    row_idx = np.repeat(np.tile(np.arange(num_modes), batch),
+                        photons_out.ravel())
+    row_idx = row_idx.reshape(batch, photon_count)
+    sub_mats = col_mat[row_idx]
+
+    _record("gen_submatrices", start, batch)
+
+    return sub_mats
+
+
 def gen_submatrix_memeff(photons_in, photons_out, unitary_mat):
     """A memory-efficient implementation of `gen_submatrix`, does not
     require the creation of an intermediate, column-only submatrix.
@@ -137,115 +459,4068 @@ def gen_submatrix_memeff(photons_in, photons_out, unitary_mat):
                 col_idx += 1
 
 
-def output_probability(photons_in, photons_out, unitary_mat):
-    """Calculate the probability of a certain photon output
-    configuration (n number of photons across m modes) given the
-    inputted photons and the unitary matrix representing a
-    linear interferometer
+def _thewalrus_permanents(mats):
+    """Permanent backend calling `thewalrus.perm` on every matrix of a
+    stack.
 
     Args:
-        photons_in ([int]):
-            A list with each integer entry representing the number
-            of individual photons in the input modes for the
-            interferometer
-        photons_out ([int]):
-            A list with each integer entry representing the number
-            of individual photons at the ouptut modes for the
-            interferometer
-        unitary_mat (np.array):
-            A unitary matrix describing an interferometer
+        mats (np.array):
+            A (batch x n x n) array of square matrices
 
     Returns:
-        float: probability photons will be detected in the given
-        `photons_out` configuration
+        np.array:
+            A 1-D complex array holding the permanent of each matrix
+    """
+
+    return np.array([thewalrus.perm(mat) for mat in mats],
+                    dtype=np.cdouble)
+
+
+def _closed_form_permanents(mats):
+    """Permanent backend using the expanded permanent formulas of 0x0 to
+    3x3 matrices, vectorized over the stack.
+
+    Args:
+        mats (np.array):
+            A (batch x n x n) array of square matrices with n <= 3
+
+    Raises:
+        ValueError:
+            If the matrices are larger than 3x3, a ValueError is raised.
+
+    Returns:
+        np.array:
+            A 1-D complex array holding the permanent of each matrix
+    """
+
+    size = mats.shape[-1]
+    if size == 0:
+        return np.ones(mats.shape[0], dtype=mats.dtype)
+    if size == 1:
+        return mats[:, 0, 0]
+    if size == 2:
+        return mats[:, 0, 0] * mats[:, 1, 1] + mats[:, 0, 1] * mats[:, 1, 0]
+    if size == 3:
+        a = mats
+        return (a[:, 0, 0] * (a[:, 1, 1] * a[:, 2, 2] +
+                              a[:, 1, 2] * a[:, 2, 1]) +
+                a[:, 0, 1] * (a[:, 1, 0] * a[:, 2, 2] +
+                              a[:, 1, 2] * a[:, 2, 0]) +
+                a[:, 0, 2] * (a[:, 1, 0] * a[:, 2, 1] +
+                              a[:, 1, 1] * a[:, 2, 0]))
+
+    raise ValueError("Closed form permanents only exist for matrices up "
+                     "to 3x3!")
+
+
+def _subset_sum_permanents(mats, glynn):
+    """Vectorized Ryser and Glynn permanent formulas for a stack of
+    matrices.
+
+    Both formulas sum a product of row sums over 2^n (Ryser) or 2^(n-1)
+    (Glynn) column selections. The selections of the lowest columns are
+    evaluated all at once as a table, while the remaining columns are
+    walked in Gray code order so each step only adds or subtracts a
+    single column from the row sums.
+
+    Args:
+        mats (np.array):
+            A (batch x n x n) array of square matrices
+        glynn (bool):
+            If True, Glynn's formula is used, otherwise Ryser's
+
+    Returns:
+        np.array:
+            A 1-D complex array holding the permanent of each matrix
     """
 
-    sub_mat = gen_submatrix(photons_in, photons_out, unitary_mat)
+    batch, size = mats.shape[0], mats.shape[-1]
+    if size == 0:
+        return np.ones(batch, dtype=mats.dtype)
+
+    # Glynn's formula fixes the sign of the first column to +1
+    free = mats[:, :, 1:] if glynn else mats
+    num_free = free.shape[-1]
+    num_low = min(num_free, 12)
+    num_high = num_free - num_low
+
+    # Bound the size of the row sum table by splitting the batch
+    chunk_size = max(1, _ROW_SUM_BYTES // ((1 << num_low) * size *
+                                           mats.itemsize))
+    if batch > chunk_size:
+        return np.concatenate([
+            _subset_sum_permanents(mats[start:start + chunk_size], glynn)
+            for start in range(0, batch, chunk_size)])
+
+    real_dtype = mats.real.dtype
+    low_bits = ((np.arange(1 << num_low)[:, None] >> np.arange(num_low)) &
+                1).astype(real_dtype)
+    low_signs = (-1.0)**low_bits.sum(axis=1)
+    if glynn:
+        # Column signs are +1 for an unset and -1 for a set bit
+        low_deltas = 1 - 2 * low_bits
+        row_sums = (np.einsum("lj,bij->bli", low_deltas, free[:, :, :num_low])
+                    + mats[:, None, :, 0])
+        high_sums = free[:, :, num_low:].sum(axis=2)
+    else:
+        row_sums = np.einsum("lj,bij->bli", low_bits, free[:, :, :num_low])
+        high_sums = np.zeros((batch, size), dtype=mats.dtype)
 
-    modulus_squared = np.abs(thewalrus.perm(sub_mat))**2
-    denom = (sp.special.factorial(photons_in).prod() *
-             sp.special.factorial(photons_out).prod())
+    total = np.zeros(batch, dtype=mats.dtype)
+    high_sign = 1.0
+    high_code = 0
+    for step in range(1 << num_high):
+        if step:
+            # The next Gray code flips the lowest set bit of `step`
+            flip = (step & -step).bit_length() - 1
+            high_code ^= 1 << flip
+            high_sign = -high_sign
+            column = free[:, :, num_low + flip]
+            if high_code >> flip & 1:
+                high_sums += -2 * column if glynn else column
+            else:
+                high_sums += 2 * column if glynn else -column
+        terms = np.prod(row_sums + high_sums[:, None, :], axis=2)
+        total += high_sign * (terms @ low_signs)
 
-    return modulus_squared / denom
+    if glynn:
+        return total / (1 << (size - 1))
 
+    return (-1)**size * total
 
-def _accel_asc(n):
-    """Jerome Kelleher's integer partition generating function,
-    obtained from: (https://jeromekelleher.net/generating-integer-
-    partitions.html).
 
-    Generates Integer partitions of any positive integer, i.e.
-    all positive integer sequences that sum up to the integer in
-    question
+def _ryser_permanents(mats):
+    """Permanent backend using Ryser's formula, see
+    `_subset_sum_permanents`.
 
     Args:
-        n (int):
-            The integer to generate partitions for
+        mats (np.array):
+            A (batch x n x n) array of square matrices
 
-    Yields:
-        [int]:
-            A list of integers that have a sum equal to n
-    """
-    a = [0 for i in range(n + 1)]
-    k = 1
-    y = n - 1
-    while k != 0:
-        x = a[k - 1] + 1
-        k -= 1
-        while 2 * x <= y:
-            a[k] = x
-            y -= x
-            k += 1
-        l = k + 1
-        while x <= y:
-            a[k] = x
-            a[l] = y
-            yield a[:k + 2]
-            x += 1
-            y -= 1
-        a[k] = x + y
-        y = x + y - 1
-        yield a[:k + 1]
+    Returns:
+        np.array:
+            A 1-D complex array holding the permanent of each matrix
+    """
 
+    return _subset_sum_permanents(mats, glynn=False)
 
-def gen_output_configurations(num_photons, num_modes):
-    """Generate all possible output photon configurations given the
-    number of photons on input and the number of modes present in the
-    input.
+
+def _glynn_permanents(mats):
+    """Permanent backend using Glynn's formula, see
+    `_subset_sum_permanents`.
 
     Args:
-        num_photons (int):
-            The total number of photons inputted into the system
-        num_modes (int):
-            The total number of modes photons can be present in
+        mats (np.array):
+            A (batch x n x n) array of square matrices
 
-    Yields:
-        [type]: [description]
-    """
-
-    # generate all possible photon outputs that sum up to the
-    # number of photons inputted.
-    # Ex: 5 photon input can produce an output of [5], [4,1],
-    # [3,2],...[1,1,1,1,1]
-    # Note that the notation above does NOT account for mode limitations
-    # so Kelleher's function (see `_accel_asc()``) may generate a
-    # configuration that is not physically feasible (exceeds number of
-    # available modes).
-    # The `len(num_photons_partition <= num_modes)` ensures this
-    # does not happen.
-    for num_photons_partition in _accel_asc(num_photons):
-        if len(num_photons_partition) <= num_modes:
-            # certain outputs may fall shy of the number of modes
-            # and need to be zero-padded
-            zero_arr = [0] * num_modes
-            for idx, val in enumerate(num_photons_partition):
-                zero_arr[idx] = val
-            # multiset_permutation usage to generate unique permutations
-            # of a list:
-            # (https://stackoverflow.com/a/41210450)
-            # for each properly padded output, generate all unique
-            # permutations of that output.
-            # Ex: [1,0,0,0] can produced [1,0,0,0], [0,1,0,0], [0,0,1,0]
-            # ,etc.
-            for p in multiset_permutations(zero_arr):
-                yield p
+    Returns:
+        np.array:
+            A 1-D complex array holding the permanent of each matrix
+    """
+
+    return _subset_sum_permanents(mats, glynn=True)
+
+
+@numba.njit(cache=True)
+def _glynn_lanes(mats_re, mats_im, out, lanes):
+    """Compiled Glynn formula on single precision matrices, with the
+    matrices laid out last so every step of the Gray code walk runs
+    over contiguous (vectorizable) lanes of `lanes` matrices.
+
+    Args:
+        mats_re (np.array):
+            An (n x n x batch) float32 array of the real parts
+        mats_im (np.array):
+            An (n x n x batch) float32 array of the imaginary parts
+        out (np.array):
+            The 1-D complex array the permanents are written to
+        lanes (int):
+            The number of matrices walked at once
+    """
+
+    size, batch = mats_re.shape[0], mats_re.shape[2]
+    for start in range(0, batch, lanes):
+        width = min(lanes, batch - start)
+        sums_re = np.zeros((size, width), dtype=np.float32)
+        sums_im = np.zeros((size, width), dtype=np.float32)
+        for i in range(size):
+            for j in range(size):
+                for b in range(width):
+                    sums_re[i, b] += mats_re[i, j, start + b]
+                    sums_im[i, b] += mats_im[i, j, start + b]
+
+        prod_re = np.empty(width, dtype=np.float32)
+        prod_im = np.empty(width, dtype=np.float32)
+        # Products are single precision, the alternating sum of them
+        # is accumulated in double precision
+        total_re = np.zeros(width)
+        total_im = np.zeros(width)
+        code = 0
+        sign = 1.0
+        for step in range(1 << (size - 1)):
+            if step:
+                # The next Gray code flips the lowest set bit of `step`
+                flip = 0
+                while not step >> flip & 1:
+                    flip += 1
+                code ^= 1 << flip
+                sign = -sign
+                if code >> flip & 1:
+                    factor = np.float32(-2.0)
+                else:
+                    factor = np.float32(2.0)
+                for i in range(size):
+                    for b in range(width):
+                        sums_re[i, b] += factor * mats_re[i, flip + 1,
+                                                          start + b]
+                        sums_im[i, b] += factor * mats_im[i, flip + 1,
+                                                          start + b]
+
+            for b in range(width):
+                prod_re[b] = sums_re[0, b]
+                prod_im[b] = sums_im[0, b]
+            for i in range(1, size):
+                for b in range(width):
+                    real = (prod_re[b] * sums_re[i, b] -
+                            prod_im[b] * sums_im[i, b])
+                    prod_im[b] = (prod_re[b] * sums_im[i, b] +
+                                  prod_im[b] * sums_re[i, b])
+                    prod_re[b] = real
+            for b in range(width):
+                total_re[b] += sign * prod_re[b]
+                total_im[b] += sign * prod_im[b]
+
+        for b in range(width):
+            out[start + b] = (complex(total_re[b], total_im[b]) /
+                              (1 << (size - 1)))
+
+
+def _single_glynn_permanents(mats):
+    """Glynn's formula for a stack of matrices in single precision, see
+    `_glynn_lanes`.
+
+    Args:
+        mats (np.array):
+            A (batch x n x n) array of square matrices
+
+    Returns:
+        np.array:
+            A 1-D complex array holding the permanent of each matrix
+    """
+
+    mats = np.asarray(mats, dtype=np.csingle)
+    permanents = np.ones(mats.shape[0], dtype=np.cdouble)
+    if mats.shape[-1] == 0:
+        return permanents
+
+    lanes = mats.transpose(1, 2, 0)
+    _glynn_lanes(np.ascontiguousarray(lanes.real),
+                 np.ascontiguousarray(lanes.imag), permanents,
+                 _SINGLE_LANES)
+
+    return permanents
+
+
+# Registered permanent backends, each one takes a (batch x n x n) stack
+# of matrices and returns the 1-D array of their permanents
+_PERMANENT_BACKENDS = {
+    "thewalrus": _thewalrus_permanents,
+    "closed_form": _closed_form_permanents,
+    "ryser": _ryser_permanents,
+    "glynn": _glynn_permanents,
+}
+
+_permanent_backend = "auto"
+
+# Backend picked by the "auto" policy for each matrix size, loaded
+# lazily from the calibration file
+_auto_backends = None
+
+
+def register_permanent_backend(name, func):
+    """Register a function as a permanent backend that can then be
+    selected with `set_permanent_backend` or the `backend` argument of
+    the probability functions.
+
+    Args:
+        name (str):
+            The name of the backend
+        func (callable):
+            A function taking a (batch x n x n) array of square matrices
+            and returning a 1-D array with the permanent of each matrix
+
+    Raises:
+        ValueError:
+            If `name` is "auto", which is reserved for the size based
+            selection policy, a ValueError is raised.
+    """
+
+    if name == "auto":
+        raise ValueError("The backend name 'auto' is reserved!")
+
+    _PERMANENT_BACKENDS[name] = func
+
+
+def set_permanent_backend(name):
+    """Select the permanent backend used when no `backend` argument is
+    passed.
+
+    Args:
+        name (str):
+            The name of a registered backend, or "auto" to pick a
+            backend per matrix size (see `calibrate_permanent_backends`)
+
+    Raises:
+        ValueError:
+            If no backend is registered under `name`, a ValueError is
+            raised.
+    """
+
+    global _permanent_backend
+
+    if name != "auto" and name not in _PERMANENT_BACKENDS:
+        raise ValueError("Unknown permanent backend '{0}'!".format(name))
+
+    _permanent_backend = name
+
+
+def get_permanent_backend():
+    """Get the name of the permanent backend used when no `backend`
+    argument is passed.
+
+    Returns:
+        str: The name of the backend
+    """
+
+    return _permanent_backend
+
+
+def _calibration_path():
+    """Get the default location of the "auto" backend calibration file.
+
+    Returns:
+        str: The path of the calibration file
+    """
+
+    cache_dir = os.environ.get("XDG_CACHE_HOME",
+                               os.path.join(os.path.expanduser("~"),
+                                            ".cache"))
+
+    return os.path.join(cache_dir, "bosonsampling", "permanent_backends.json")
+
+
+def _auto_backend(size):
+    """Pick the backend the "auto" policy uses for a given matrix size.
+
+    Sizes covered by the calibration file use the backend measured to
+    be fastest, others fall back to the closed forms for matrices up to
+    3x3 and `thewalrus` for anything larger.
+
+    Args:
+        size (int):
+            The dimension of the square matrices
+
+    Returns:
+        str: The name of the backend
+    """
+
+    global _auto_backends
+
+    if _auto_backends is None:
+        try:
+            with open(_calibration_path()) as calibration_file:
+                _auto_backends = {int(size): name for size, name in
+                                  json.load(calibration_file).items()}
+        except (OSError, ValueError):
+            _auto_backends = {}
+
+    name = _auto_backends.get(size)
+    if name in _PERMANENT_BACKENDS:
+        return name
+
+    return "closed_form" if size <= 3 else "thewalrus"
+
+
+def calibrate_permanent_backends(max_size=16, batch=64, path=None,
+                                 backends=None, rng=None):
+    """Time every permanent backend on random matrices of each size and
+    save the fastest one per size for the "auto" policy.
+
+    Args:
+        max_size (int, optional):
+            The largest matrix size to time. Defaults to 16.
+        batch (int, optional):
+            The number of matrices per timed stack. Defaults to 64.
+        path (str, optional):
+            Where to save the calibration. Defaults to
+            `$XDG_CACHE_HOME/bosonsampling/permanent_backends.json`.
+        backends ([str], optional):
+            The backends to time. Defaults to every registered backend.
+        rng (np.random.Generator or int, optional):
+            A random number generator or a seed for one.
+            Defaults to None (fresh, unseeded generator).
+
+    Returns:
+        dict: The fastest backend name for every matrix size
+    """
+
+    global _auto_backends
+
+    rng = np.random.default_rng(rng)
+    if backends is None:
+        backends = list(_PERMANENT_BACKENDS)
+    if path is None:
+        path = _calibration_path()
+
+    fastest = {}
+    for size in range(1, max_size + 1):
+        mats = (rng.standard_normal((batch, size, size)) +
+                1j * rng.standard_normal((batch, size, size)))
+        timings = {}
+        for name in backends:
+            func = _PERMANENT_BACKENDS[name]
+            try:
+                # Untimed call first, so compilation (e.g. numba in
+                # thewalrus) is not counted
+                func(mats[:1])
+                start = time.perf_counter()
+                func(mats)
+                timings[name] = time.perf_counter() - start
+            except ValueError:
+                continue
+        fastest[size] = min(timings, key=timings.get)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as calibration_file:
+        json.dump({str(size): name for size, name in fastest.items()},
+                  calibration_file, indent=4)
+
+    if path == _calibration_path():
+        _auto_backends = fastest
+
+    return fastest
+
+
+def _permanents(sub_mats, backend=None, precision="double"):
+    """Calculate the permanent of every matrix in a stack of square
+    matrices with the selected permanent backend.
+
+    Args:
+        sub_mats (np.array):
+            A (batch x n x n) array of square matrices
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+        precision (str, optional):
+            The floating point precision the permanents are calculated
+            in, "single", "double" or "extended". Other than "double",
+            the backend is ignored and the closed forms (up to 3x3) or
+            Glynn's formula run in that precision. In single precision
+            Glynn's formula is compiled and several times faster than
+            the double precision backends, with a relative error
+            growing from about 1e-6 at 8x8 to 1e-3 at 18x18 (see
+            `precision_check`). In extended precision it is vectorized
+            with NumPy and several times slower. Defaults to "double".
+
+    Returns:
+        np.array:
+            A 1-D complex (double precision) array holding the permanent
+            of each matrix
+    """
+
+    if backend is None:
+        backend = _permanent_backend
+    if backend == "auto":
+        backend = _auto_backend(sub_mats.shape[-1])
+
+    if sub_mats.shape[0] == 0:
+        return np.zeros(0, dtype=np.cdouble)
+
+    if _stats is not None:
+        _stats.matrix_sizes[sub_mats.shape[-1]] += sub_mats.shape[0]
+
+    if precision != "double":
+        # Glynn's formula loses less accuracy to cancellation than
+        # Ryser's, the closed forms have no cancellation at all
+        mats = sub_mats.astype(_precision_dtype(precision), copy=False)
+        if mats.shape[-1] <= 3:
+            return np.asarray(_closed_form_permanents(mats),
+                              dtype=np.cdouble)
+        if precision == "single":
+            return _single_glynn_permanents(mats)
+        return np.asarray(_glynn_permanents(mats), dtype=np.cdouble)
+
+    return np.asarray(_PERMANENT_BACKENDS[backend](sub_mats),
+                      dtype=np.cdouble)
+
+
+def permanent(mat, backend=None, precision="double"):
+    """Calculate the permanent of a square matrix, or of every matrix
+    in a stack of square matrices.
+
+    Args:
+        mat (np.array):
+            A square matrix or a (batch x n x n) array of square
+            matrices
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+        precision (str, optional):
+            The floating point precision the permanent is calculated
+            in, see `_permanents`. Defaults to "double".
+
+    Returns:
+        complex or np.array:
+            The permanent, or a 1-D array of permanents if a stack of
+            matrices was given
+    """
+
+    mat = np.asarray(mat, dtype=_precision_dtype(precision))
+    if mat.ndim == 2:
+        return _permanents(mat[None], backend, precision)[0]
+
+    return _permanents(mat, backend, precision)
+
+
+def approximate_permanent(mat, tolerance=0.01, delta=0.05, samples=None,
+                          rng=None):
+    """Estimate the permanent of a square matrix with Gurvits'
+    randomized algorithm (https://doi.org/10.1007/11534273_2), which
+    averages Glynn's estimator prod_i x_i prod_i (A x)_i over random
+    +-1 vectors x at a cost of O(n^2) per sample.
+
+    With probability at least 1 - `delta` the estimate is within
+    `tolerance` * ||A||^n (||A|| being the spectral norm) of the
+    permanent, by Hoeffding's inequality on the real and imaginary
+    parts.
+
+    Args:
+        mat (np.array):
+            A square matrix
+        tolerance (float, optional):
+            The additive error relative to ||A||^n. Defaults to 0.01.
+        delta (float, optional):
+            The probability the error exceeds the bound.
+            Defaults to 0.05.
+        samples (int, optional):
+            The number of random vectors to average over, overriding
+            the number derived from `tolerance`. Defaults to None.
+        rng (np.random.Generator or int, optional):
+            A random number generator or a seed for one.
+            Defaults to None (fresh, unseeded generator).
+
+    Returns:
+        Estimate:
+            The (complex) estimated permanent and its standard error,
+            with `low` and `high` bounding the modulus of the permanent
+            at confidence 1 - `delta`
+    """
+
+    rng = np.random.default_rng(rng)
+    mat = np.asarray(mat, dtype=np.cdouble)
+    size = mat.shape[0]
+
+    if samples is None:
+        samples = math.ceil(4 * math.log(4 / delta) / tolerance**2)
+    else:
+        tolerance = math.sqrt(4 * math.log(4 / delta) / samples)
+
+    total = 0j
+    total_squared = 0.0
+    for start in range(0, samples, _BATCH_SIZE):
+        signs = rng.choice([-1.0, 1.0],
+                           size=(min(_BATCH_SIZE, samples - start), size))
+        values = signs.prod(axis=1) * np.prod(signs @ mat.T, axis=1)
+        total += values.sum()
+        total_squared += (np.abs(values)**2).sum()
+
+    value = total / samples
+    variance = max(0.0, total_squared / samples - abs(value)**2)
+    stderr = math.sqrt(variance / samples)
+
+    bound = tolerance * np.linalg.norm(mat, 2)**size if size else 0.0
+
+    return Estimate(complex(value), stderr,
+                    float(max(0.0, abs(value) - bound)),
+                    float(abs(value) + bound))
+
+
+def _multiplicity_terms(photons):
+    """Number of terms the multiplicity-aware permanent sums over when
+    iterating over the photon counts of `photons`, i.e. the product of
+    (count + 1) over every occupied mode.
+
+    Args:
+        photons ([int]):
+            A list with each integer entry representing the number
+            of individual photons in each mode
+
+    Returns:
+        int: The number of terms
+    """
+
+    return math.prod(int(count) + 1 for count in photons if count > 0)
+
+
+def _use_multiplicities(photons_in, photons_out):
+    """Decide if the permanent for a pair of photon configurations is
+    cheaper to calculate with `_multiplicity_permanent` than with a
+    full permanent of the (photons x photons) submatrix, which is the
+    case when enough photons bunch in the input or output modes.
+
+    Configurations are taken along the last axis, and the decisions of
+    stacked configurations are broadcast against each other, so a whole
+    batch is decided at once.
+
+    Args:
+        photons_in (np.array):
+            An input photon configuration, or an array of them
+        photons_out (np.array):
+            An output photon configuration, or an array of them
+
+    Returns:
+        np.array: True where `_multiplicity_permanent` should be used
+    """
+
+    photons_in = np.asarray(photons_in)
+    photons_out = np.asarray(photons_out)
+    photon_count = photons_in.sum(axis=-1)
+    in_terms = np.where(photons_in > 0, photons_in + 1,
+                        1).prod(axis=-1, dtype=np.double)
+    out_terms = np.where(photons_out > 0, photons_out + 1,
+                         1).prod(axis=-1, dtype=np.double)
+
+    # Every term of the multiplicity sum adds a column to the row sums
+    # of the occupied modes on the other side and multiplies n factors,
+    # while a full permanent costs about n 2^n operations (Glynn/Ryser
+    # with Gray code ordering). Both were timed on the same machine.
+    cost = np.where(
+        in_terms <= out_terms,
+        in_terms * (np.count_nonzero(photons_out, axis=-1) + photon_count),
+        out_terms * (np.count_nonzero(photons_in, axis=-1) + photon_count))
+
+    return cost + _MULTIPLICITY_CALL_COST < photon_count * 2.0**photon_count
+
+
+def _multiplicity_permanent(photons_in, photons_out, unitary_mat):
+    """Calculate the permanent of the submatrix `gen_submatrix` would
+    build without expanding repeated rows and columns, using Ryser's
+    formula generalized to multiplicities:
+
+        Per = sum_k (-1)^(n - |k|) prod_j C(t_j, k_j)
+              prod_i (sum_j k_j U_ij)^(s_i)
+
+    where t (s) are the photon counts of the occupied input (output)
+    modes and every k_j runs from 0 to t_j, giving prod_j (t_j + 1)
+    terms instead of 2^n. The sum runs over whichever side has fewer
+    terms (the permanent of the transpose is identical).
+
+    The terms of the lowest columns are evaluated all at once as a
+    table, while the remaining columns are walked in mixed-radix Gray
+    code order, so each step only adds or subtracts a single column
+    from the row sums.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        photons_out ([int]):
+            A list with each integer entry representing the number
+            of individual photons at the ouptut modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+
+    Returns:
+        complex: The permanent of the photon submatrix
+    """
+
+    photons_in = np.asarray(photons_in, dtype=np.intp)
+    photons_out = np.asarray(photons_out, dtype=np.intp)
+    in_modes = np.flatnonzero(photons_in)
+    out_modes = np.flatnonzero(photons_out)
+
+    # Rows are output modes and columns are input modes, the sum over
+    # k runs over the columns
+    mat = np.asarray(unitary_mat, dtype=np.cdouble)[out_modes[:, None],
+                                                    in_modes]
+    col_counts = photons_in[in_modes]
+    row_counts = photons_out[out_modes]
+    if _multiplicity_terms(row_counts) < _multiplicity_terms(col_counts):
+        mat = mat.T
+        col_counts, row_counts = row_counts, col_counts
+
+    # Columns with few photons go into the table first, so it fills
+    # up as closely as possible to its size limit
+    order = np.argsort(col_counts, kind="stable")
+    mat = mat[:, order]
+    col_counts = col_counts[order].tolist()
+    num_rows = mat.shape[0]
+
+    # Each column contributes a factor C(t_j, k_j) (-1)^(t_j - k_j)
+    col_weights = [np.array([(-1)**(count - k) * math.comb(count, k)
+                             for k in range(count + 1)], dtype=np.double)
+                   for count in col_counts]
+
+    num_low = 0
+    low_terms = 1
+    while (num_low < len(col_counts) and
+           low_terms * (col_counts[num_low] + 1) <= 1 << 12):
+        low_terms *= col_counts[num_low] + 1
+        num_low += 1
+
+    low_sums = np.zeros((1, num_rows), dtype=np.cdouble)
+    low_weights = np.ones(1)
+    for col in range(num_low):
+        multiples = np.arange(col_counts[col] + 1.0)
+        low_sums = (low_sums[None] + multiples[:, None, None] *
+                    mat[:, col]).reshape(-1, num_rows)
+        low_weights = np.outer(col_weights[col], low_weights).ravel()
+
+    # Raising the row sums to the output counts by repeated
+    # multiplication, the rows of level l have a count of at least l
+    levels = [np.flatnonzero(row_counts >= level)
+              for level in range(1, int(row_counts.max(initial=0)) + 1)]
+
+    high_counts = col_counts[num_low:]
+    high_cols = mat[:, num_low:].T
+    high_weights = col_weights[num_low:]
+    high_sums = np.zeros(num_rows, dtype=np.cdouble)
+    high_k = [0] * len(high_counts)
+    directions = [1] * len(high_counts)
+
+    permanent = 0j
+    for step in range(math.prod(count + 1 for count in high_counts)):
+        if step:
+            # The next reflected Gray code moves the lowest digit that
+            # can still move in its direction, reversing the ones below
+            col = 0
+            while not 0 <= high_k[col] + directions[col] <= high_counts[col]:
+                directions[col] = -directions[col]
+                col += 1
+            high_k[col] += directions[col]
+            if directions[col] > 0:
+                high_sums += high_cols[col]
+            else:
+                high_sums -= high_cols[col]
+
+        sums = low_sums + high_sums
+        terms = np.ones(sums.shape[0], dtype=np.cdouble)
+        for rows in levels:
+            terms *= sums[:, rows].prod(axis=1)
+        weight = math.prod(weights[k]
+                           for weights, k in zip(high_weights, high_k))
+        permanent += weight * (terms @ low_weights)
+
+    return permanent
+
+
+def _overlap_matrix(overlap, photon_count):
+    """Build the Gram matrix of the internal states of the input
+    photons from a pairwise overlap or validate a given Gram matrix.
+
+    Args:
+        overlap (float or np.array):
+            The overlap of the internal states of every pair of
+            photons, or their (photons x photons) Gram matrix
+        photon_count (int):
+            The number of input photons
+
+    Raises:
+        ValueError:
+            If a scalar overlap is not between 0 and 1 or a Gram matrix
+            is not photons x photons, a ValueError is raised.
+
+    Returns:
+        np.array: The (photons x photons) complex Gram matrix
+    """
+
+    if np.ndim(overlap) == 0:
+        if not 0 <= overlap <= 1:
+            raise ValueError("Overlap must be between 0 and 1!")
+        return (np.full((photon_count, photon_count), overlap,
+                        dtype=np.cdouble) +
+                (1 - overlap) * np.eye(photon_count))
+
+    gram = np.asarray(overlap, dtype=np.cdouble)
+    if gram.shape != (photon_count, photon_count):
+        raise ValueError("Overlap matrix must be photons x photons!")
+
+    return gram
+
+
+def _partially_distinguishable_sum(sub_mat, gram, order, backend=None):
+    """Calculate the sum over permutations sigma of the input photons of
+
+        prod_c gram[sigma(c), c] Per(sub_mat * conj(sub_mat[:, sigma]))
+
+    which replaces |Per(sub_mat)|^2 for photons whose internal states
+    have the Gram matrix `gram`, keeping only the permutations that
+    move at most `order` photons (Renema et al.,
+    https://arxiv.org/abs/1707.02793).
+
+    Each permanent is Laplace-expanded over the j moved columns D and
+    the j rows R paired with them. The remaining factor is the
+    permanent of |sub_mat|^2 without R and D, shared by every
+    derangement of D, so order k needs sum_{j <= k} C(n, j)^2
+    permanents of size n - j plus as many j x j permanents per
+    derangement. These exact permanents make the cost exponential in
+    n even for a small order, see `_partially_distinguishable_estimate`
+    for a polynomial alternative.
+
+    Args:
+        sub_mat (np.array):
+            The (photons x photons) submatrix of the unitary matrix
+        gram (np.array):
+            The (photons x photons) Gram matrix of the photon internal
+            states, ordered like the columns of `sub_mat`
+        order (int):
+            The maximum number of photons a permutation may move
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+
+    Returns:
+        float: The truncated sum
+    """
+
+    photon_count = sub_mat.shape[0]
+    intensities = np.abs(sub_mat)**2
+    photons = np.arange(photon_count)
+    total = 0j
+
+    for moved in range(min(order, photon_count) + 1):
+        derangements = [perm for perm in itertools.permutations(range(moved))
+                        if all(perm[i] != i for i in range(moved))]
+        if not derangements:
+            continue
+        derangements = np.array(derangements, dtype=np.intp).reshape(
+            len(derangements), moved)
+
+        subsets = np.array(list(itertools.combinations(photons, moved)),
+                           dtype=np.intp).reshape(
+                               math.comb(photon_count, moved), moved)
+        complements = np.array([np.setdiff1d(photons, subset)
+                                for subset in subsets],
+                               dtype=np.intp).reshape(subsets.shape[0],
+                                                      photon_count - moved)
+
+        for cols, rest in zip(subsets, complements):
+            # Factor of the photons that stay put, for every row subset
+            if rest.shape[0]:
+                fixed = _permanents(intensities[complements[:, :, None],
+                                                rest[None, None, :]],
+                                    backend)
+            else:
+                fixed = np.ones(subsets.shape[0], dtype=np.cdouble)
+
+            permuted = cols[derangements]
+            weights = (gram[permuted, cols].prod(axis=1) *
+                       np.diag(gram)[rest].prod())
+
+            if moved:
+                rows = subsets[:, None, :, None]
+                mats = (sub_mat[rows, cols[None, None, None, :]] *
+                        sub_mat[rows, permuted[None, :, None, :]].conj())
+                interfering = _permanents(
+                    mats.reshape(-1, moved, moved), backend).reshape(
+                        subsets.shape[0], derangements.shape[0])
+            else:
+                interfering = np.ones((1, 1), dtype=np.cdouble)
+
+            total += fixed @ (interfering @ weights)
+
+    return float(total.real)
+
+
+def _partially_distinguishable_estimate(sub_mat, gram, order,
+                                        tolerance=0.01, delta=0.05,
+                                        rng=None):
+    """Estimate the truncated sum of `_partially_distinguishable_sum`
+    at a cost polynomial in the number of photons for a fixed order.
+
+    Writing A = |sub_mat|^2, the order j terms are sums over j rows R
+    and j columns D of Per(A without R and D) T(R, D), where T(R, D)
+    holds the j x j interfering permanents of every derangement of D.
+    Since Per(A_RD) Per(A without R and D) sums the products prod_i
+    A[i, pi(i)] of the permutations pi mapping R to D,
+
+        sum = sum_pi prod_i A[i, pi(i)] sum_{j, R} T(R, pi(R)) /
+              Per(A_R,pi(R))
+
+    is averaged over permutations drawn by sequential importance
+    sampling (row by row, with probabilities proportional to the
+    Sinkhorn-balanced A over the columns left). A sample costs
+    sum_{j <= k} C(n, j) permanents of size j, as in the algorithm of
+    Renema et al. (https://arxiv.org/abs/1707.02793) where the
+    nonnegative permanents of the distinguishable photons are
+    approximated rather than calculated. The small permanents are
+    evaluated in stacks with the closed forms or Glynn's formula.
+
+    Samples are drawn in batches until the standard error is below
+    `tolerance` times the estimate, or 65536 samples were drawn.
+
+    Args:
+        sub_mat (np.array):
+            The (photons x photons) submatrix of the unitary matrix
+        gram (np.array):
+            The (photons x photons) Gram matrix of the photon internal
+            states, ordered like the columns of `sub_mat`
+        order (int):
+            The maximum number of photons a permutation may move
+        tolerance (float, optional):
+            The standard error relative to the estimate at which
+            sampling stops. Defaults to 0.01.
+        delta (float, optional):
+            One minus the confidence level of the interval.
+            Defaults to 0.05.
+        rng (np.random.Generator or int, optional):
+            A random number generator or a seed for one.
+            Defaults to None (fresh, unseeded generator).
+
+    Returns:
+        Estimate:
+            The estimated truncated sum, its standard error and a normal
+            confidence interval at confidence 1 - `delta`
+    """
+
+    rng = np.random.default_rng(rng)
+    photon_count = sub_mat.shape[0]
+    intensities = np.abs(sub_mat)**2
+    diagonal = np.diag(gram)
+    order = min(order, photon_count)
+
+    # A zero row or column zeroes every term of the sum
+    if (np.any(intensities.sum(axis=0) == 0) or
+            np.any(intensities.sum(axis=1) == 0)):
+        return Estimate(0.0, 0.0, 0.0, 0.0)
+
+    # Balancing the proposal makes the sampled products far more even
+    # than sampling proportionally to A itself
+    proposal = intensities.copy()
+    for _ in range(20):
+        proposal /= proposal.sum(axis=1, keepdims=True)
+        proposal /= proposal.sum(axis=0, keepdims=True)
+
+    moved_terms = []
+    for moved in range(1, order + 1):
+        derangements = np.array(
+            [perm for perm in itertools.permutations(range(moved))
+             if all(perm[i] != i for i in range(moved))],
+            dtype=np.intp).reshape(-1, moved)
+        if derangements.shape[0]:
+            rows = np.array(list(itertools.combinations(
+                range(photon_count), moved)), dtype=np.intp).reshape(
+                    math.comb(photon_count, moved), moved)
+            moved_terms.append((moved, derangements, rows))
+
+    batch = 1024
+    total = 0.0
+    total_squared = 0.0
+    samples = 0
+    while True:
+        # Draw a batch of permutations row by row, and the importance
+        # weights prod_i A[i, pi(i)] / q(pi)
+        cols = np.zeros((batch, photon_count), dtype=np.intp)
+        weights = np.ones(batch)
+        available = np.ones((batch, photon_count), dtype=bool)
+        for row in range(photon_count):
+            row_weights = proposal[row] * available
+            cumulative = np.cumsum(row_weights, axis=1)
+            totals = cumulative[:, -1].copy()
+            # Samples left without a possible column have weight zero
+            stuck = totals == 0
+            totals[stuck] = 1.0
+            thresholds = (1 - rng.random(batch)) * totals
+            choice = np.minimum((cumulative < thresholds[:, None]).sum(axis=1),
+                                photon_count - 1)
+            cols[:, row] = choice
+            weights *= np.where(
+                stuck, 0.0, intensities[row, choice] * totals /
+                np.where(stuck, 1.0, row_weights[np.arange(batch),
+                                                 choice]))
+            available[np.arange(batch), choice] = False
+
+        values = np.full(batch, diagonal.prod(), dtype=np.cdouble)
+        for moved, derangements, rows in moved_terms:
+            # Split the row subsets to bound the stacked matrices
+            chunk_size = max(1, (1 << 20) // (
+                batch * derangements.shape[0] * moved * moved))
+            kernel = (_closed_form_permanents if moved <= 3 else
+                      _glynn_permanents)
+            for start in range(0, rows.shape[0], chunk_size):
+                subsets = rows[start:start + chunk_size]
+                moved_cols = cols[:, subsets]
+                permuted = moved_cols[:, :, derangements]
+                rows_idx = subsets[None, :, None, :, None]
+
+                pair_perms = kernel(
+                    intensities[subsets[None, :, :, None],
+                                moved_cols[:, :, None, :]].reshape(
+                                    -1, moved, moved)).real.reshape(
+                                        moved_cols.shape[:2])
+                mats = (sub_mat[rows_idx, moved_cols[:, :, None, None, :]] *
+                        sub_mat[rows_idx,
+                                permuted[:, :, :, None, :]].conj())
+                interfering = kernel(mats.reshape(-1, moved, moved)).reshape(
+                    permuted.shape[:3])
+                overlaps = gram[permuted, moved_cols[:, :, None, :]].prod(
+                    axis=3)
+                terms = ((overlaps * interfering).sum(axis=2) *
+                         diagonal.prod() / diagonal[moved_cols].prod(axis=2))
+                values += np.divide(terms, pair_perms,
+                                    out=np.zeros_like(terms),
+                                    where=pair_perms > 0).sum(axis=1)
+
+        values = weights * values.real
+        total += values.sum()
+        total_squared += (values**2).sum()
+        samples += batch
+
+        value = total / samples
+        stderr = math.sqrt(max(0.0, total_squared / samples - value**2) /
+                           samples)
+        if stderr <= tolerance * abs(value) or samples >= 1 << 16:
+            break
+
+    z = sp.stats.norm.ppf(1 - delta / 2)
+
+    return Estimate(float(value), stderr, float(value - z * stderr),
+                    float(value + z * stderr))
+
+
+def unitary_digest(unitary_mat):
+    """Calculate a content hash of a unitary matrix, identifying it in
+    a `ProbabilityCache` independently of the Python object holding it.
+
+    Args:
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+
+    Returns:
+        str: The hex SHA-256 digest of the matrix shape and values
+    """
+
+    unitary_mat = np.ascontiguousarray(unitary_mat, dtype=np.cdouble)
+    digest = hashlib.sha256(str(unitary_mat.shape).encode())
+    digest.update(unitary_mat.tobytes())
+
+    return digest.hexdigest()
+
+
+class ProbabilityCache:
+    """A cache of output configuration probabilities keyed by the
+    content hash of the unitary matrix and the (photons_in, photons_out)
+    pair.
+
+    Probabilities are held in an in-memory LRU tier bounded to `maxsize`
+    entries and, if a `path` is given, in an SQLite database on disk
+    that survives process restarts. Entries evicted from memory remain
+    available on disk. A cache can be shared between threads.
+
+    Args:
+        maxsize (int, optional):
+            The maximum number of probabilities kept in memory.
+            Defaults to 65536.
+        path (str, optional):
+            The SQLite database file of the on-disk tier. Defaults to
+            None (memory only).
+
+    Attributes:
+        hits (int):
+            The number of lookups answered by either tier
+        misses (int):
+            The number of lookups neither tier could answer
+    """
+
+    def __init__(self, maxsize=65536, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()
+        self._db = None
+        self._lock = threading.Lock()
+
+        if path is not None:
+            # The connection is only used under `_lock`
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS probabilities ("
+                             "unitary TEXT, photons_in TEXT, "
+                             "photons_out TEXT, probability REAL, "
+                             "PRIMARY KEY (unitary, photons_in, "
+                             "photons_out))")
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._memory)
+
+    @staticmethod
+    def _keys(digest, photons_in, photons_out):
+        prefix = (digest, ",".join(map(str, photons_in)))
+        return [prefix + (",".join(map(str, configuration)),)
+                for configuration in np.asarray(photons_out).tolist()]
+
+    def _remember(self, key, probability):
+        self._memory[key] = probability
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def lookup(self, digest, photons_in, photons_out):
+        """Look up the cached probabilities of many output
+        configurations.
+
+        Args:
+            digest (str):
+                The `unitary_digest` of the unitary matrix
+            photons_in ([int]):
+                The input photon configuration
+            photons_out (np.array):
+                A 2-D array with one output configuration per row
+
+        Returns:
+            (np.array, np.array):
+                A 1-D float array of probabilities (NaN where missing)
+                and a boolean array marking the missing configurations
+        """
+
+        keys = self._keys(digest, photons_in, photons_out)
+        probabilities = np.full(len(keys), np.nan)
+
+        with self._lock:
+            on_disk = []
+            for idx, key in enumerate(keys):
+                probability = self._memory.get(key)
+                if probability is None:
+                    on_disk.append(idx)
+                else:
+                    self._memory.move_to_end(key)
+                    probabilities[idx] = probability
+
+            if self._db is not None and on_disk:
+                found = {}
+                for start in range(0, len(on_disk), _SQLITE_CHUNK):
+                    chunk = [keys[idx][2] for idx in
+                             on_disk[start:start + _SQLITE_CHUNK]]
+                    found.update(self._db.execute(
+                        "SELECT photons_out, probability FROM "
+                        "probabilities WHERE unitary = ? AND "
+                        "photons_in = ? AND photons_out IN ({0})".format(
+                            ", ".join("?" * len(chunk))),
+                        keys[0][:2] + tuple(chunk)))
+                for idx in on_disk:
+                    probability = found.get(keys[idx][2])
+                    if probability is not None:
+                        self._remember(keys[idx], probability)
+                        probabilities[idx] = probability
+
+            missing = np.isnan(probabilities)
+            self.misses += int(missing.sum())
+            self.hits += len(probabilities) - int(missing.sum())
+
+        return probabilities, missing
+
+    def store(self, digest, photons_in, photons_out, probabilities):
+        """Add the probabilities of many output configurations to the
+        cache.
+
+        Args:
+            digest (str):
+                The `unitary_digest` of the unitary matrix
+            photons_in ([int]):
+                The input photon configuration
+            photons_out (np.array):
+                A 2-D array with one output configuration per row
+            probabilities (np.array):
+                The probability of each row of `photons_out`
+        """
+
+        rows = [key + (float(probability),) for key, probability in
+                zip(self._keys(digest, photons_in, photons_out),
+                    probabilities)]
+
+        with self._lock:
+            for row in rows:
+                self._remember(row[:3], row[3])
+            if self._db is not None:
+                self._db.executemany("INSERT OR REPLACE INTO probabilities "
+                                     "VALUES (?, ?, ?, ?)", rows)
+                self._db.commit()
+
+    def clear(self):
+        """Remove every probability from both tiers and reset the hit
+        and miss counters."""
+
+        with self._lock:
+            self._memory.clear()
+            self.hits = 0
+            self.misses = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM probabilities")
+                self._db.commit()
+
+    def close(self):
+        """Close the on-disk tier, if any."""
+
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def output_probability(photons_in, photons_out, unitary_mat, backend=None,
+                       cache=None, approximate=False, tolerance=0.01,
+                       delta=0.05, rng=None, overlap=None, order=None,
+                       precision="double"):
+    """Calculate the probability of a certain photon output
+    configuration (n number of photons across m modes) given the
+    inputted photons and the unitary matrix representing a
+    linear interferometer
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        photons_out ([int]):
+            A list with each integer entry representing the number
+            of individual photons at the ouptut modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        backend (str, optional):
+            The name of the permanent backend (or "auto") used for
+            permanents that are not calculated with multiplicities.
+            Defaults to the backend selected with
+            `set_permanent_backend`.
+        cache (ProbabilityCache, optional):
+            A cache probabilities are looked up in before and stored in
+            after being calculated. Defaults to None (no caching).
+        approximate (bool, optional):
+            If True, the permanent is estimated with
+            `approximate_permanent` instead of calculated exactly.
+            Approximations are never cached. Defaults to False.
+        tolerance (float, optional):
+            The additive error of the approximate permanent relative to
+            ||A||^n, see `approximate_permanent`. With `overlap` and
+            `order`, the standard error relative to the estimate at
+            which sampling stops instead. Defaults to 0.01.
+        delta (float, optional):
+            The probability the approximate permanent exceeds the error
+            bound, or the estimate falls outside its interval.
+            Defaults to 0.05.
+        rng (np.random.Generator or int, optional):
+            A random number generator, or a seed for one, used by the
+            approximation. Defaults to None (fresh, unseeded generator).
+        overlap (float or np.array, optional):
+            The overlap |<psi_i|psi_j>| of the internal states of every
+            pair of input photons, or the (photons x photons) Gram
+            matrix <psi_i|psi_j> of the internal states, with photons
+            ordered by input mode. If given, the photons are partially
+            distinguishable, and `cache` and `approximate` are ignored.
+            Defaults to None (indistinguishable photons).
+        order (int, optional):
+            With `overlap`, only permutations of the photons moving at
+            most `order` of them are summed over, and the permanents of
+            the photons that stay put are estimated by sampling, see
+            `_partially_distinguishable_estimate`. The cost is then
+            polynomial in the number of photons for a fixed order, and
+            an `Estimate` is returned. Defaults to None (all
+            permutations, exact and exponential in the number of
+            photons).
+        precision (str, optional):
+            The floating point precision permanents are calculated in,
+            "single", "double" or "extended" (see `_permanents`).
+            Probabilities are only cached in double precision.
+            Defaults to "double".
+
+    Raises:
+        ValueError:
+            If the number of photons inputted does not equal the number
+            of photons output or `overlap` is invalid, a ValueError is
+            raised.
+
+    Returns:
+        float or Estimate: probability photons will be detected in the
+        given `photons_out` configuration. If `approximate` is True (or
+        `overlap` and `order` are given), an `Estimate` whose `low` and
+        `high` bound the probability at confidence 1 - `delta`.
+    """
+
+    if overlap is not None:
+        sub_mat = gen_submatrix(photons_in, photons_out, unitary_mat)
+        photon_count = sub_mat.shape[0]
+        gram = _overlap_matrix(overlap, photon_count)
+        denom = (math.prod(map(math.factorial, photons_in)) *
+                 math.prod(map(math.factorial, photons_out)))
+        if order is None:
+            return (_partially_distinguishable_sum(sub_mat, gram,
+                                                   photon_count, backend) /
+                    denom)
+        estimate = _partially_distinguishable_estimate(
+            sub_mat, gram, order, tolerance, delta, rng)
+        return Estimate(estimate.value / denom, estimate.stderr / denom,
+                        estimate.low / denom, estimate.high / denom)
+
+    if approximate:
+        sub_mat = gen_submatrix(photons_in, photons_out, unitary_mat)
+        estimate = approximate_permanent(sub_mat, tolerance, delta, rng=rng)
+        denom = (sp.special.factorial(photons_in).prod() *
+                 sp.special.factorial(photons_out).prod())
+        return Estimate(float(abs(estimate.value)**2 / denom),
+                        float(2 * abs(estimate.value) * estimate.stderr /
+                              denom),
+                        float(estimate.low**2 / denom),
+                        float(estimate.high**2 / denom))
+
+    if cache is not None and precision == "double":
+        digest = unitary_digest(unitary_mat)
+        probability, missing = cache.lookup(digest, photons_in, [photons_out])
+        if not missing[0]:
+            return probability[0]
+        probability = output_probability(photons_in, photons_out,
+                                         unitary_mat, backend)
+        cache.store(digest, photons_in, [photons_out], [probability])
+        return probability
+
+    call_start = _timer()
+
+    if precision == "double" and _use_multiplicities(photons_in,
+                                                     photons_out):
+        if sum(photons_in) != sum(photons_out):
+            raise ValueError("Number of photons inputted is not equal"
+                             "to number outputted!")
+        start = _timer()
+        permanent = _multiplicity_permanent(photons_in, photons_out,
+                                            unitary_mat)
+        _record("output_probability.multiplicity_permanent", start)
+    else:
+        sub_mat = gen_submatrix(photons_in, photons_out, unitary_mat,
+                                precision)
+        start = _timer()
+        permanent = _permanents(sub_mat[None], backend, precision)[0]
+        _record("output_probability.permanent", start)
+
+    start = _timer()
+    modulus_squared = np.abs(permanent)**2
+    denom = (math.prod(map(math.factorial, photons_in)) *
+             math.prod(map(math.factorial, photons_out)))
+    probability = modulus_squared / denom
+    _record("output_probability.normalization", start)
+
+    _record("output_probability", call_start)
+
+    return probability
+
+
+def batch_output_probability(photons_in, photons_out, unitary_mat,
+                             backend=None, workers=None, cache=None,
+                             precision="double"):
+    """A batched version of `output_probability` that calculates the
+    probabilities of many output configurations sharing the same
+    photon input.
+
+    The input factorial product, the column gather of the unitary
+    matrix and the table of output factorials are only computed once
+    for the whole batch.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        photons_out (np.array):
+            A 2-D array with one output configuration per row, each
+            integer entry representing the number of individual photons
+            at the output modes for the interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        backend (str, optional):
+            The name of the permanent backend (or "auto") used for
+            permanents that are not calculated with multiplicities.
+            Defaults to the backend selected with
+            `set_permanent_backend`.
+        workers (int, optional):
+            The number of worker processes the configurations are split
+            over. Defaults to None (no process pool).
+        cache (ProbabilityCache, optional):
+            A cache probabilities are looked up in before and stored in
+            after being calculated. Defaults to None (no caching).
+        precision (str, optional):
+            The floating point precision permanents are calculated in,
+            "single", "double" or "extended" (see `_permanents`).
+            Probabilities are only cached in double precision.
+            Defaults to "double".
+
+    Returns:
+        np.array:
+            A 1-D float array with the probability of each row of
+            `photons_out`
+    """
+
+    photons_out = np.atleast_2d(np.asarray(photons_out, dtype=np.intp))
+    photon_count = int(np.sum(photons_in))
+
+    if cache is not None and precision == "double":
+        # Only the configurations missing from the cache are calculated
+        digest = unitary_digest(unitary_mat)
+        probabilities, missing = cache.lookup(digest, photons_in,
+                                              photons_out)
+        if missing.any():
+            probabilities[missing] = batch_output_probability(
+                photons_in, photons_out[missing], unitary_mat, backend,
+                workers)
+            cache.store(digest, photons_in, photons_out[missing],
+                        probabilities[missing])
+        return probabilities
+
+    if workers is not None and workers > 1:
+        return _parallel_probabilities(photons_in, unitary_mat,
+                                       photons_out.shape[0], _BATCH_SIZE,
+                                       backend, workers, photons_out,
+                                       precision=precision)
+
+    if photons_out.shape[0] > _BATCH_SIZE:
+        # Bound the size of the stacked submatrices
+        return np.concatenate([
+            batch_output_probability(photons_in,
+                                     photons_out[start:start + _BATCH_SIZE],
+                                     unitary_mat, backend,
+                                     precision=precision)
+            for start in range(0, photons_out.shape[0], _BATCH_SIZE)])
+
+    call_start = _timer()
+
+    # Configurations where enough photons bunch are cheaper to evaluate
+    # without expanding their repeated rows and columns
+    bunched = np.zeros(photons_out.shape[0], dtype=bool)
+    if precision == "double":
+        bunched = _use_multiplicities(photons_in, photons_out)
+
+    permanents = np.empty(photons_out.shape[0], dtype=np.cdouble)
+    sub_mats = gen_submatrices(photons_in, photons_out[~bunched],
+                               unitary_mat, precision)
+    start = _timer()
+    permanents[~bunched] = _permanents(sub_mats, backend, precision)
+    _record("batch_output_probability.permanent", start,
+            sub_mats.shape[0])
+
+    start = _timer()
+    permanents[bunched] = [
+        _multiplicity_permanent(photons_in, configuration, unitary_mat)
+        for configuration in photons_out[bunched]]
+    _record("batch_output_probability.multiplicity_permanent", start,
+            int(bunched.sum()))
+
+    start = _timer()
+    modulus_squared = np.abs(permanents)**2
+
+    # n! for every possible per-mode photon count, so the output
+    # normalization is a table lookup rather than a factorial call
+    factorials = sp.special.factorial(np.arange(photon_count + 1))
+    denom = (factorials[np.asarray(photons_in, dtype=np.intp)].prod() *
+             factorials[photons_out].prod(axis=1))
+    probabilities = modulus_squared / denom
+    _record("batch_output_probability.normalization", start,
+            photons_out.shape[0])
+
+    _record("batch_output_probability", call_start, photons_out.shape[0])
+
+    return probabilities
+
+
+def _factorial_products(photons):
+    """Calculate the product of the factorials of the photon counts of
+    every mode, for every configuration in a 2-D array, by looking the
+    factorials up in a table.
+
+    Args:
+        photons (np.array):
+            A 2-D integer array with one photon configuration per row
+
+    Returns:
+        np.array:
+            A 1-D float array with the factorial product of each row
+    """
+
+    factorials = np.cumprod(np.r_[1.0, np.arange(1, photons.max(initial=0) +
+                                                 1)])
+
+    return factorials[photons].prod(axis=1)
+
+
+def output_probabilities(inputs, outputs, unitary_mat, paired=False,
+                         backend=None):
+    """Calculate the probabilities of many output configurations for
+    many input configurations on the same interferometer, either for
+    every (input, output) combination or for matching rows only.
+
+    The rows of the unitary matrix are gathered once per output and its
+    columns once per input, the factorial normalizations once per
+    configuration, and the submatrices are evaluated in batches.
+
+    Args:
+        inputs (np.array):
+            A 2-D array with one input configuration per row
+        outputs (np.array):
+            A 2-D array with one output configuration per row
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        paired (bool, optional):
+            If True, only the probability of the i-th output for the
+            i-th input is calculated. Defaults to False (every
+            combination).
+        backend (str, optional):
+            The name of the permanent backend (or "auto") used for
+            permanents that are not calculated with multiplicities.
+            Defaults to the backend selected with
+            `set_permanent_backend`.
+
+    Raises:
+        ValueError:
+            If the configurations do not all hold the same number of
+            photons, or `paired` is True and the number of inputs and
+            outputs differ, a ValueError is raised.
+
+    Returns:
+        np.array:
+            An (inputs x outputs) float array with the probability of
+            every output for every input, or if `paired` is True a 1-D
+            array with the probability of each pair
+    """
+
+    inputs = np.atleast_2d(np.asarray(inputs, dtype=np.intp))
+    outputs = np.atleast_2d(np.asarray(outputs, dtype=np.intp))
+    unitary_mat = np.asarray(unitary_mat, dtype=np.cdouble)
+
+    photon_counts = np.unique(np.r_[inputs.sum(axis=1), outputs.sum(axis=1)])
+    if photon_counts.shape[0] > 1:
+        raise ValueError("Number of photons inputted is not equal "
+                         "to number outputted!")
+    if paired and inputs.shape[0] != outputs.shape[0]:
+        raise ValueError("Number of paired inputs is not equal "
+                         "to number of outputs!")
+
+    call_start = _timer()
+    input_modes = occupation_to_modes(inputs)
+    output_modes = occupation_to_modes(outputs)
+
+    if paired:
+        bunched = _use_multiplicities(inputs, outputs)
+    else:
+        bunched = _use_multiplicities(inputs[:, None], outputs)
+
+    permanents = np.empty(bunched.shape, dtype=np.cdouble)
+    if paired:
+        plain = np.flatnonzero(~bunched)
+        for start in range(0, plain.shape[0], _BATCH_SIZE):
+            chunk = plain[start:start + _BATCH_SIZE]
+            permanents[chunk] = _permanents(
+                unitary_mat[output_modes[chunk, :, None],
+                            input_modes[chunk, None, :]], backend)
+    else:
+        # Gather the rows of a chunk of outputs, then the columns of
+        # every input from those rows
+        chunk_size = max(1, _BATCH_SIZE // max(1, inputs.shape[0]))
+        for start in range(0, outputs.shape[0], chunk_size):
+            stop = start + chunk_size
+            rows = unitary_mat[output_modes[start:stop]]
+            sub_mats = rows[:, :, input_modes].transpose(2, 0, 1, 3)
+            plain = ~bunched[:, start:stop]
+            permanents[:, start:stop][plain] = _permanents(sub_mats[plain],
+                                                           backend)
+
+    for pair in zip(*np.nonzero(bunched)):
+        input_index = pair[0]
+        output_index = pair[0] if paired else pair[1]
+        permanents[pair] = _multiplicity_permanent(
+            inputs[input_index], outputs[output_index], unitary_mat)
+
+    input_denoms = _factorial_products(inputs)
+    output_denoms = _factorial_products(outputs)
+    if paired:
+        denom = input_denoms * output_denoms
+    else:
+        denom = input_denoms[:, None] * output_denoms[None, :]
+    probabilities = np.abs(permanents)**2 / denom
+
+    _record("output_probabilities", call_start, bunched.size)
+
+    return probabilities
+
+
+def _transmission_vector(transmission, num_modes):
+    """Expand a uniform transmission to one per input mode, or validate
+    per-mode transmissions.
+
+    Args:
+        transmission (float or [float]):
+            The probability a photon is not lost, for every input mode
+            or for each of them
+        num_modes (int):
+            The total number of modes photons can be present in
+
+    Raises:
+        ValueError:
+            If a transmission is not between 0 and 1 or there is not
+            one for every mode, a ValueError is raised.
+
+    Returns:
+        np.array: A 1-D float array with the transmission of each mode
+    """
+
+    transmission = np.broadcast_to(np.asarray(transmission, dtype=np.double),
+                                   np.shape(transmission) or (num_modes,))
+    if transmission.shape != (num_modes,):
+        raise ValueError("Transmission must be given for every mode!")
+    if np.any((transmission < 0) | (transmission > 1)):
+        raise ValueError("Transmission must be between 0 and 1!")
+
+    return transmission
+
+
+def lossy_output_probability(photons_in, photons_out, unitary_mat,
+                             transmission, backend=None, cache=None):
+    """Calculate the probability of output configurations when photons
+    can be lost before entering the interferometer, so an output may
+    hold fewer photons than were inputted.
+
+    Loss is modeled per input mode (uniform loss commutes with the
+    interferometer, so a uniform transmission equally models loss at the
+    detectors). The probability is a sum over the configurations t' of
+    the surviving photons, weighted by prod_j C(t_j, t'_j) eta_j^t'_j
+    (1 - eta_j)^(t_j - t'_j). Lost photons are grouped by input mode
+    rather than enumerated as subsets, so photons bunched in an input
+    mode give one term per surviving count, and every surviving
+    configuration is evaluated for all outputs with the same number of
+    photons in one `batch_output_probability` call.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        photons_out ([int]):
+            An output configuration, or a 2-D array with one output
+            configuration per row
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        transmission (float or [float]):
+            The probability a photon entering the interferometer is not
+            lost, for every input mode or for each of them
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+        cache (ProbabilityCache, optional):
+            A cache the lossless probabilities are looked up in before
+            and stored in after being calculated. Defaults to None (no
+            caching).
+
+    Raises:
+        ValueError:
+            If an output holds more photons than were inputted or the
+            transmission is invalid, a ValueError is raised.
+
+    Returns:
+        float or np.array:
+            The probability, or a 1-D array with the probability of each
+            row of `photons_out`
+    """
+
+    photons_in = np.asarray(photons_in, dtype=np.intp)
+    photons_out = np.asarray(photons_out, dtype=np.intp)
+    outputs = np.atleast_2d(photons_out)
+    transmission = _transmission_vector(transmission, photons_in.shape[0])
+
+    totals = outputs.sum(axis=1)
+    if np.any(totals > photons_in.sum()):
+        raise ValueError("Number of photons outputted exceeds "
+                         "number inputted!")
+
+    # Every configuration of surviving photons and its probability
+    in_modes = np.flatnonzero(photons_in)
+    counts = photons_in[in_modes]
+    surviving = np.stack(np.unravel_index(
+        np.arange(_multiplicity_terms(counts)), counts + 1), axis=1)
+    weights = (sp.special.comb(counts, surviving) *
+               transmission[in_modes]**surviving *
+               (1 - transmission[in_modes])**(counts - surviving)).prod(axis=1)
+
+    survivor_totals = surviving.sum(axis=1)
+
+    probabilities = np.zeros(outputs.shape[0], dtype=np.double)
+    for total in np.unique(totals):
+        rows = totals == total
+        for pattern, weight in zip(surviving[survivor_totals == total],
+                                   weights[survivor_totals == total]):
+            if weight == 0:
+                continue
+            if total == 0:
+                probabilities[rows] += weight
+                continue
+            survivors = np.zeros_like(photons_in)
+            survivors[in_modes] = pattern
+            probabilities[rows] += weight * batch_output_probability(
+                survivors, outputs[rows], unitary_mat, backend, cache=cache)
+
+    if photons_out.ndim == 1:
+        return float(probabilities[0])
+
+    return probabilities
+
+
+def num_output_configurations(num_photons, num_modes):
+    """Calculate the number of possible output photon configurations,
+    i.e. the number of ways `num_photons` indistinguishable photons can
+    be distributed over `num_modes` modes.
+
+    Args:
+        num_photons (int):
+            The total number of photons inputted into the system
+        num_modes (int):
+            The total number of modes photons can be present in
+
+    Returns:
+        int: The number of output configurations, C(n + m - 1, n)
+    """
+
+    return math.comb(num_photons + num_modes - 1, num_photons)
+
+
+def _composition_table(num_photons, num_modes):
+    """Build the lookup table used to rank and unrank output
+    configurations (the combinatorial number system for
+    compositions).
+
+    Entry [s, p] is the number of ways `s` photons can be distributed
+    over `p` modes, C(s + p - 1, p - 1) (with exactly one way of putting
+    zero photons into zero modes).
+
+    Args:
+        num_photons (int):
+            The total number of photons inputted into the system
+        num_modes (int):
+            The total number of modes photons can be present in
+
+    Returns:
+        np.array:
+            A (num_photons + 1 x num_modes + 1) array. It is an int64
+            array unless the counts overflow 64 bits, in which case it
+            holds Python integers.
+    """
+
+    table = [[math.comb(s + p - 1, p - 1) if p > 0 else int(s == 0)
+              for p in range(num_modes + 1)]
+             for s in range(num_photons + 1)]
+
+    if num_output_configurations(num_photons, num_modes + 1) < 2**63:
+        return np.array(table, dtype=np.int64)
+
+    return np.array(table, dtype=object)
+
+
+def rank_configuration(photons_out):
+    """Calculate the position (rank) of output configurations in the
+    lexicographic ordering of all configurations with the same number of
+    photons and modes, [0,...,0,n] having rank 0 and [n,0,...,0] having
+    the last rank.
+
+    Args:
+        photons_out (np.array):
+            A single output configuration or a 2-D array with one
+            output configuration per row
+
+    Returns:
+        int or np.array:
+            The rank of `photons_out`, or a 1-D array of ranks if a
+            2-D array of configurations was given
+    """
+
+    photons_out = np.asarray(photons_out, dtype=np.intp)
+    configurations = np.atleast_2d(photons_out)
+    num_modes = configurations.shape[1]
+    photon_count = configurations.sum(axis=1)
+    table = _composition_table(int(photon_count.max(initial=0)), num_modes)
+
+    # Photons still left to place before each mode
+    remaining = (photon_count[:, None] -
+                 np.cumsum(configurations, axis=1) + configurations)
+
+    # Every configuration that places fewer photons in mode `i` (with
+    # the same photons in the modes before it) is ranked lower. Summing
+    # the number of those configurations over the remaining modes
+    # telescopes to the difference of two table entries.
+    modes_left = num_modes - np.arange(num_modes)
+    ranks = (table[remaining, modes_left] -
+             table[remaining - configurations, modes_left]).sum(axis=1)
+
+    if photons_out.ndim == 1:
+        return int(ranks[0])
+
+    return ranks
+
+
+def unrank_configuration(index, num_photons, num_modes):
+    """Calculate the output configuration at a given position (rank) in
+    the lexicographic ordering of all configurations, the inverse of
+    `rank_configuration`.
+
+    Args:
+        index (int or np.array):
+            A single rank or a 1-D array of ranks
+        num_photons (int):
+            The total number of photons inputted into the system
+        num_modes (int):
+            The total number of modes photons can be present in
+
+    Raises:
+        ValueError:
+            If any rank is negative or not smaller than the number of
+            output configurations, a ValueError is raised.
+
+    Returns:
+        np.array:
+            The output configuration at `index`, or a 2-D array with one
+            configuration per row if an array of ranks was given
+    """
+
+    table = _composition_table(num_photons, num_modes)
+    scalar = np.ndim(index) == 0
+    index = np.atleast_1d(np.asarray(index, dtype=table.dtype)).copy()
+
+    if index.size and (index.min() < 0 or
+                       index.max() >= table[num_photons, num_modes]):
+        raise ValueError("Configuration rank is out of range!")
+
+    configurations = np.empty((index.shape[0], num_modes), dtype=np.intp)
+    remaining = np.full(index.shape[0], num_photons, dtype=np.intp)
+    for mode in range(num_modes):
+        counts = table[:, num_modes - mode]
+        # Undo the telescoped sum of `rank_configuration`: find the
+        # fewest photons left for the remaining modes whose block of
+        # configurations still contains the rank
+        left = np.searchsorted(counts, counts[remaining] - index,
+                               side="left")
+        configurations[:, mode] = remaining - left
+        index -= counts[remaining] - counts[left]
+        remaining = left
+
+    if scalar:
+        return configurations[0]
+
+    return configurations
+
+
+def shard_range(size, index, count):
+    """Split the ranks 0 to `size` into `count` contiguous shards of
+    (nearly) equal size and get the rank range of one of them.
+
+    Args:
+        size (int):
+            The number of ranks to split
+        index (int):
+            The index of the shard, from 0 to `count` - 1
+        count (int):
+            The number of shards
+
+    Raises:
+        ValueError:
+            If `index` is not a valid shard index, a ValueError is
+            raised.
+
+    Returns:
+        (int, int): The first rank and one past the last rank of the shard
+    """
+
+    if not 0 <= index < count:
+        raise ValueError("Shard index {0} is out of range for {1} shards!"
+                         .format(index, count))
+
+    return size * index // count, size * (index + 1) // count
+
+
+def gen_output_configuration_chunks(num_photons, num_modes,
+                                    chunk_size=65536, start=0, stop=None,
+                                    shard=None):
+    """Generate output photon configurations in lexicographic order as
+    chunks of a 2-D array.
+
+    Args:
+        num_photons (int):
+            The total number of photons inputted into the system
+        num_modes (int):
+            The total number of modes photons can be present in
+        chunk_size (int, optional):
+            The maximum number of configurations per chunk.
+            Defaults to 65536.
+        start (int, optional):
+            Rank of the first configuration to generate. Defaults to 0.
+        stop (int, optional):
+            Rank one past the last configuration to generate. Defaults
+            to the number of output configurations.
+        shard ((int, int), optional):
+            An (index, count) pair. If given, only the `index`-th of
+            `count` contiguous, equally sized rank ranges between
+            `start` and `stop` is generated. Defaults to None.
+
+    Yields:
+        np.array:
+            A (chunk x num_modes) integer array of output configurations
+    """
+
+    if stop is None:
+        stop = num_output_configurations(num_photons, num_modes)
+    if shard is not None:
+        shard_start, shard_stop = shard_range(stop - start, *shard)
+        start, stop = start + shard_start, start + shard_stop
+
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        yield unrank_configuration(np.arange(chunk_start, chunk_stop),
+                                   num_photons, num_modes)
+
+
+def gen_output_configurations(num_photons, num_modes):
+    """Generate all possible output photon configurations given the
+    number of photons on input and the number of modes present in the
+    input.
+
+    Configurations are generated in lexicographic order, see
+    `gen_output_configuration_chunks` for a faster, array based
+    version.
+
+    Args:
+        num_photons (int):
+            The total number of photons inputted into the system
+        num_modes (int):
+            The total number of modes photons can be present in
+
+    Yields:
+        [int]:
+            A list with each integer entry representing the number of
+            individual photons at the output modes
+    """
+
+    start = _timer()
+    for chunk in gen_output_configuration_chunks(num_photons, num_modes):
+        chunk = chunk.tolist()
+        # Only the enumeration itself is timed, not the caller's work
+        # between configurations
+        _record("gen_output_configurations", start, len(chunk))
+        yield from chunk
+        start = _timer()
+
+
+def _rank_range_probabilities(photons_in, unitary_mat, start, stop,
+                              chunk_size, backend=None, workers=None,
+                              precision="double"):
+    """Calculate the probabilities of the output configurations ranked
+    `start` to `stop`, in chunks or on a process pool.
+
+    Args:
+        photons_in ([int]):
+            The input photon configuration
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        start (int):
+            Rank of the first configuration
+        stop (int):
+            Rank one past the last configuration
+        chunk_size (int):
+            The number of configurations calculated at the same time
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+        workers (int, optional):
+            The number of worker processes. Defaults to None (no process
+            pool).
+        precision (str, optional):
+            The floating point precision permanents are calculated in,
+            "single", "double" or "extended" (see `_permanents`).
+            Defaults to "double".
+
+    Returns:
+        np.array:
+            A 1-D float array of probabilities
+    """
+
+    if workers is not None and workers > 1:
+        return _parallel_probabilities(photons_in, unitary_mat,
+                                       stop - start, chunk_size, backend,
+                                       workers, offset=start,
+                                       precision=precision)
+
+    probabilities = np.empty(stop - start, dtype=np.double)
+    idx = 0
+    for chunk in gen_output_configuration_chunks(
+            int(np.sum(photons_in)), len(photons_in), chunk_size=chunk_size,
+            start=start, stop=stop):
+        probabilities[idx:idx + chunk.shape[0]] = batch_output_probability(
+            photons_in, chunk, unitary_mat, backend, precision=precision)
+        idx += chunk.shape[0]
+
+    return probabilities
+
+
+def output_distribution(photons_in, unitary_mat, return_configurations=False,
+                        chunk_size=4096, backend=None, workers=None,
+                        cache=None, shard=None, precision="double"):
+    """Calculate the probability of every possible output photon
+    configuration at once.
+
+    Probabilities are ordered lexicographically by output configuration
+    ([0,...,0,n] first and [n,0,...,0] last) so the probability of a
+    configuration is found at index `rank_configuration(configuration)`.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        return_configurations (bool, optional):
+            If True, the output configurations the probabilities belong
+            to are also returned. Defaults to False.
+        chunk_size (int, optional):
+            The number of output configurations whose submatrices are
+            built at the same time, bounding memory usage.
+            Defaults to 4096.
+        backend (str, optional):
+            The name of the permanent backend (or "auto") used for
+            permanents that are not calculated with multiplicities.
+            Defaults to the backend selected with
+            `set_permanent_backend`.
+        workers (int, optional):
+            The number of worker processes the configurations are split
+            over (in rank ranges). Defaults to None (no process pool).
+        cache (ProbabilityCache, optional):
+            A cache probabilities are looked up in before and stored in
+            after being calculated. Defaults to None (no caching).
+        shard ((int, int), optional):
+            An (index, count) pair. If given, only the `index`-th of
+            `count` contiguous, equally sized rank ranges of the
+            configurations is calculated, without generating any earlier
+            configuration. Defaults to None (every configuration).
+        precision (str, optional):
+            The floating point precision permanents are calculated in,
+            "single", "double" or "extended" (see `_permanents`).
+            Probabilities are only cached in double precision.
+            Defaults to "double".
+
+    Returns:
+        np.array or (np.array, np.array):
+            A 1-D float array of probabilities (of the shard's rank
+            range only if `shard` is given) and, if
+            `return_configurations` is True, the
+            (configurations x modes) array of output configurations
+    """
+
+    num_photons = int(np.sum(photons_in))
+    num_modes = len(photons_in)
+    start, stop = 0, num_output_configurations(num_photons, num_modes)
+    if shard is not None:
+        start, stop = shard_range(stop, *shard)
+
+    if cache is not None:
+        configurations = unrank_configuration(np.arange(start, stop),
+                                              num_photons, num_modes)
+        probabilities = batch_output_probability(photons_in, configurations,
+                                                 unitary_mat, backend,
+                                                 workers, cache, precision)
+    else:
+        probabilities = _rank_range_probabilities(photons_in, unitary_mat,
+                                                   start, stop, chunk_size,
+                                                   backend, workers,
+                                                   precision)
+
+    if return_configurations:
+        configurations = unrank_configuration(np.arange(start, stop),
+                                              num_photons, num_modes)
+        return probabilities, configurations
+
+    return probabilities
+
+
+def _write_progress(path, progress):
+    """Atomically replace a JSON progress file, so an interrupted write
+    never leaves a partially written file behind.
+
+    Args:
+        path (str):
+            The progress file
+        progress (dict):
+            The progress to record
+    """
+
+    with open(path + ".tmp", "w") as progress_file:
+        json.dump(progress, progress_file)
+    os.replace(path + ".tmp", path)
+
+
+def stream_distribution(photons_in, unitary_mat, path, chunk_size=65536,
+                        backend=None, workers=None, shard=None,
+                        precision="double"):
+    """Calculate the probability of every possible output photon
+    configuration, writing them chunk by chunk to a memory-mapped `.npy`
+    file instead of holding them in memory.
+
+    The probability of a configuration is stored at index
+    `rank_configuration(configuration)` (minus the first rank of the
+    shard if `shard` is given, see `merge_shards`). Progress is recorded
+    in `path + ".progress"` after every chunk, so calling the function
+    again with the same arguments after an interruption resumes from
+    the last finished chunk (and returns immediately once the file is
+    complete). With `workers`, a single process pool calculates every
+    chunk.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        path (str):
+            The `.npy` file the probabilities are written to
+        chunk_size (int, optional):
+            The number of probabilities calculated and written at a
+            time. Defaults to 65536.
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+        workers (int, optional):
+            The number of worker processes each chunk is split over.
+            Defaults to None (no process pool).
+        shard ((int, int), optional):
+            An (index, count) pair. If given, only the `index`-th of
+            `count` contiguous, equally sized rank ranges of the
+            configurations is calculated and written, without generating
+            any earlier configuration. Defaults to None (every
+            configuration).
+        precision (str, optional):
+            The floating point precision permanents are calculated in,
+            "single", "double" or "extended" (see `_permanents`).
+            Defaults to "double".
+
+    Raises:
+        ValueError:
+            If a progress file for a different input configuration,
+            unitary matrix or shard already exists at `path`, a
+            ValueError is raised.
+
+    Returns:
+        np.array:
+            The finished probabilities, memory-mapped read-only from
+            `path`
+    """
+
+    num_photons = int(np.sum(photons_in))
+    num_modes = len(photons_in)
+    size = num_output_configurations(num_photons, num_modes)
+    start, stop = 0, size
+    if shard is not None:
+        start, stop = shard_range(size, *shard)
+
+    progress_path = path + ".progress"
+    progress = {"photons_in": [int(count) for count in photons_in],
+                "unitary": unitary_digest(unitary_mat),
+                "size": size,
+                "start": start,
+                "stop": stop,
+                "next": start}
+
+    if os.path.exists(progress_path) and os.path.exists(path):
+        with open(progress_path) as progress_file:
+            saved = json.load(progress_file)
+        if any(saved.get(key) != progress[key] for key in
+               ("photons_in", "unitary", "start", "stop")):
+            raise ValueError("{0} belongs to a different distribution!"
+                             .format(path))
+        progress["next"] = saved["next"]
+        probabilities = np.lib.format.open_memmap(path, mode="r+")
+    else:
+        probabilities = np.lib.format.open_memmap(path, mode="w+",
+                                                  dtype=np.double,
+                                                  shape=(stop - start,))
+        _write_progress(progress_path, progress)
+
+    if workers is not None and workers > 1 and progress["next"] < stop:
+        pool = _probability_pool(photons_in, unitary_mat,
+                                 min(chunk_size, stop - start), backend,
+                                 workers, precision=precision)
+    else:
+        pool = contextlib.nullcontext(functools.partial(
+            _rank_range_probabilities, photons_in, unitary_mat,
+            backend=backend, precision=precision))
+
+    with pool as evaluate:
+        for chunk_start in range(progress["next"], stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            probabilities[chunk_start - start:chunk_stop - start] = \
+                evaluate(chunk_start, chunk_stop, chunk_size)
+            probabilities.flush()
+
+            progress["next"] = chunk_stop
+            _write_progress(progress_path, progress)
+
+    del probabilities
+
+    return np.load(path, mmap_mode="r")
+
+
+def merge_shards(paths, path, tolerance=1e-8, chunk_size=1 << 20):
+    """Stitch the shard files written by `stream_distribution` back
+    together into the `.npy` file of the full distribution, checking
+    that the shards are finished, belong to the same distribution,
+    cover every configuration exactly once and that the probabilities
+    sum to one.
+
+    Args:
+        paths ([str]):
+            The `.npy` files of the shards (in any order)
+        path (str):
+            The `.npy` file the full distribution is written to
+        tolerance (float, optional):
+            The maximum allowed deviation of the probability sum from
+            one. Defaults to 1e-8.
+        chunk_size (int, optional):
+            The number of probabilities copied at a time.
+            Defaults to 1048576.
+
+    Raises:
+        ValueError:
+            If a shard is unfinished, the shards do not belong to the
+            same distribution, leave gaps or overlap, or the
+            probabilities do not sum to one, a ValueError is raised.
+
+    Returns:
+        np.array:
+            The full distribution, memory-mapped read-only from `path`
+    """
+
+    shards = []
+    for shard_path in paths:
+        with open(shard_path + ".progress") as progress_file:
+            progress = json.load(progress_file)
+        if progress["next"] != progress["stop"]:
+            raise ValueError("{0} is unfinished!".format(shard_path))
+        shards.append((progress, shard_path))
+    shards.sort(key=lambda shard: shard[0]["start"])
+
+    expected = 0
+    for progress, shard_path in shards:
+        if any(progress[key] != shards[0][0][key] for key in
+               ("photons_in", "unitary", "size")):
+            raise ValueError("{0} belongs to a different distribution!"
+                             .format(shard_path))
+        if progress["start"] != expected:
+            raise ValueError("Shards do not cover ranks {0} to {1} exactly "
+                             "once!".format(expected, progress["start"]))
+        expected = progress["stop"]
+
+    size = shards[0][0]["size"] if shards else 0
+    if expected != size:
+        raise ValueError("Shards do not cover ranks {0} to {1}!"
+                         .format(expected, size))
+
+    probabilities = np.lib.format.open_memmap(path, mode="w+",
+                                              dtype=np.double,
+                                              shape=(size,))
+    total = 0.0
+    for progress, shard_path in shards:
+        shard = np.load(shard_path, mmap_mode="r")
+        for start in range(0, shard.shape[0], chunk_size):
+            chunk = shard[start:start + chunk_size]
+            probabilities[progress["start"] + start:
+                          progress["start"] + start + chunk.shape[0]] = chunk
+            total += math.fsum(chunk)
+    probabilities.flush()
+    del probabilities
+
+    if abs(total - 1) > tolerance:
+        raise ValueError("Probabilities sum to {0} instead of one!"
+                         .format(total))
+
+    return np.load(path, mmap_mode="r")
+
+
+# Shared memory attached by every process pool worker, see
+# `_init_worker`
+_worker_state = {}
+
+
+def _init_worker(photons_in, backend, unitary_name, unitary_shape,
+                 result_name, result_size, outputs_name, outputs_shape,
+                 precision):
+    """Process pool initializer attaching a worker to the shared memory
+    holding the unitary matrix, the result buffer and (optionally) the
+    output configurations.
+
+    Args:
+        photons_in ([int]):
+            The input photon configuration
+        backend (str):
+            The name of the permanent backend (or "auto")
+        unitary_name (str):
+            Name of the shared memory block holding the unitary matrix
+        unitary_shape ((int, int)):
+            Shape of the unitary matrix
+        result_name (str):
+            Name of the shared memory block holding the probabilities
+        result_size (int):
+            Number of probabilities in the result buffer
+        outputs_name (str):
+            Name of the shared memory block holding the output
+            configurations, None if configurations are unranked from
+            their rank instead
+        outputs_shape ((int, int)):
+            Shape of the output configurations array
+        precision (str):
+            The floating point precision permanents are calculated in
+    """
+
+    blocks = [shared_memory.SharedMemory(name=unitary_name),
+              shared_memory.SharedMemory(name=result_name)]
+    _worker_state["blocks"] = blocks
+    _worker_state["photons_in"] = photons_in
+    _worker_state["backend"] = backend
+    _worker_state["unitary"] = np.ndarray(unitary_shape, dtype=np.cdouble,
+                                          buffer=blocks[0].buf)
+    _worker_state["result"] = np.ndarray(result_size, dtype=np.double,
+                                         buffer=blocks[1].buf)
+    _worker_state["precision"] = precision
+    _worker_state["photons_out"] = None
+    if outputs_name is not None:
+        blocks.append(shared_memory.SharedMemory(name=outputs_name))
+        _worker_state["photons_out"] = np.ndarray(outputs_shape,
+                                                  dtype=np.intp,
+                                                  buffer=blocks[2].buf)
+
+
+def _worker_probabilities(start, stop, position):
+    """Process pool task calculating the probabilities of the output
+    configurations ranked `start` to `stop` (or of rows `start` to
+    `stop` of the shared output configurations) straight into the
+    shared result buffer, from index `position` on.
+
+    Args:
+        start (int):
+            Rank (or row) of the first configuration
+        stop (int):
+            Rank (or row) one past the last configuration
+        position (int):
+            Index of the first probability in the result buffer
+    """
+
+    photons_in = _worker_state["photons_in"]
+    if _worker_state["photons_out"] is None:
+        photons_out = unrank_configuration(np.arange(start, stop),
+                                           int(np.sum(photons_in)),
+                                           len(photons_in))
+    else:
+        photons_out = _worker_state["photons_out"][start:stop]
+
+    _worker_state["result"][position:position + stop - start] = \
+        batch_output_probability(photons_in, photons_out,
+                                 _worker_state["unitary"],
+                                 _worker_state["backend"],
+                                 precision=_worker_state["precision"])
+
+
+@contextlib.contextmanager
+def _probability_pool(photons_in, unitary_mat, size, backend, workers,
+                      photons_out=None, precision="double"):
+    """Start a process pool calculating output probabilities, which
+    can be used for many ranges of configurations.
+
+    The unitary matrix, the result buffer and the output configurations
+    live in shared memory so nothing but index ranges is pickled per
+    task, and every worker writes its probabilities straight into the
+    single result array. The pool and the shared memory are created
+    once and released when the block exits.
+
+    Args:
+        photons_in ([int]):
+            The input photon configuration
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        size (int):
+            The largest number of probabilities calculated at once
+        backend (str):
+            The name of the permanent backend (or "auto"). Backends
+            registered at runtime are only available to the workers
+            when processes are forked.
+        workers (int):
+            The number of worker processes
+        photons_out (np.array, optional):
+            A 2-D array of output configurations. Defaults to None, in
+            which case the configurations are calculated from their
+            ranks.
+        precision (str, optional):
+            The floating point precision permanents are calculated in,
+            "single", "double" or "extended" (see `_permanents`).
+            Defaults to "double".
+
+    Yields:
+        callable:
+            A function of `start`, `stop` and `chunk_size` returning the
+            probabilities of the configurations ranked (or rows of
+            `photons_out`) `start` to `stop`, at most `size` of them,
+            split into tasks of at most `chunk_size` configurations
+    """
+
+    unitary_mat = np.asarray(unitary_mat, dtype=np.cdouble)
+    photons_in = np.asarray(photons_in, dtype=np.intp)
+
+    blocks = []
+    try:
+        unitary_shm = shared_memory.SharedMemory(
+            create=True, size=max(1, unitary_mat.nbytes))
+        blocks.append(unitary_shm)
+        np.ndarray(unitary_mat.shape, dtype=np.cdouble,
+                   buffer=unitary_shm.buf)[:] = unitary_mat
+
+        result_shm = shared_memory.SharedMemory(create=True,
+                                                size=max(1, size * 8))
+        blocks.append(result_shm)
+        result = np.ndarray(size, dtype=np.double, buffer=result_shm.buf)
+
+        outputs_name = None
+        outputs_shape = None
+        if photons_out is not None:
+            outputs_shm = shared_memory.SharedMemory(
+                create=True, size=max(1, photons_out.nbytes))
+            blocks.append(outputs_shm)
+            outputs_name = outputs_shm.name
+            outputs_shape = photons_out.shape
+            np.ndarray(outputs_shape, dtype=np.intp,
+                       buffer=outputs_shm.buf)[:] = photons_out
+
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker,
+                initargs=(photons_in, backend, unitary_shm.name,
+                          unitary_mat.shape, result_shm.name, size,
+                          outputs_name, outputs_shape,
+                          precision)) as pool:
+
+            def evaluate(start, stop, chunk_size):
+                # Several tasks per worker keep the pool balanced even
+                # though the cost of a configuration depends on how its
+                # photons bunch
+                count = stop - start
+                chunk_size = max(1, min(chunk_size,
+                                        -(-count // (4 * workers))))
+                tasks = [pool.submit(_worker_probabilities,
+                                     start + position,
+                                     min(start + position + chunk_size,
+                                         stop),
+                                     position)
+                         for position in range(0, count, chunk_size)]
+                for task in concurrent.futures.as_completed(tasks):
+                    task.result()
+
+                return result[:count].copy()
+
+            yield evaluate
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def _parallel_probabilities(photons_in, unitary_mat, size, chunk_size,
+                            backend, workers, photons_out=None, offset=0,
+                            precision="double"):
+    """Calculate output probabilities on a process pool, see
+    `_probability_pool`.
+
+    Args:
+        photons_in ([int]):
+            The input photon configuration
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        size (int):
+            The number of probabilities to calculate
+        chunk_size (int):
+            The maximum number of probabilities per task
+        backend (str):
+            The name of the permanent backend (or "auto")
+        workers (int):
+            The number of worker processes
+        photons_out (np.array, optional):
+            A 2-D array of output configurations. Defaults to None, in
+            which case the configurations are calculated in rank order.
+        offset (int, optional):
+            Rank of the first configuration when `photons_out` is None.
+            Defaults to 0.
+        precision (str, optional):
+            The floating point precision permanents are calculated in,
+            "single", "double" or "extended" (see `_permanents`).
+            Defaults to "double".
+
+    Returns:
+        np.array:
+            A 1-D float array of probabilities
+    """
+
+    with _probability_pool(photons_in, unitary_mat, size, backend,
+                           workers, photons_out, precision) as evaluate:
+        return evaluate(offset, offset + size, chunk_size)
+
+
+def occupation_to_modes(photons):
+    """Convert photon configurations from the dense occupation
+    representation (photon count per mode) to the sparse mode list
+    representation (sorted mode index of every photon), e.g. [1,2,0,0]
+    becomes [0,1,1].
+
+    Args:
+        photons (np.array):
+            A single photon configuration or a 2-D array with one
+            configuration per row (all holding the same number of
+            photons)
+
+    Returns:
+        np.array:
+            The mode list, or a (batch x photons) array of mode lists
+    """
+
+    photons = np.asarray(photons, dtype=np.intp)
+    if photons.ndim == 1:
+        return _photon_indices(photons)
+
+    batch, num_modes = photons.shape
+    photon_count = int(photons[0].sum()) if batch else 0
+
+    return np.repeat(np.tile(np.arange(num_modes), batch),
+                     photons.ravel()).reshape(batch, photon_count)
+
+
+def modes_to_occupation(modes, num_modes):
+    """Convert photon configurations from the sparse mode list
+    representation back to the dense occupation representation.
+
+    Args:
+        modes (np.array):
+            A single mode list or a 2-D array with one mode list per row
+        num_modes (int):
+            The total number of modes photons can be present in
+
+    Returns:
+        np.array:
+            The occupation, or a (batch x num_modes) array of
+            occupations
+    """
+
+    modes = np.asarray(modes, dtype=np.intp)
+    if modes.ndim == 1:
+        return np.bincount(modes, minlength=num_modes)
+
+    photons = np.zeros((modes.shape[0], num_modes), dtype=np.intp)
+    np.add.at(photons, (np.arange(modes.shape[0])[:, None], modes), 1)
+
+    return photons
+
+
+def modes_to_pairs(modes):
+    """Compress a mode list into (mode, count) pairs of the occupied
+    modes, e.g. [0,1,1] becomes [[0,1],[1,2]].
+
+    Args:
+        modes (np.array):
+            A mode list
+
+    Returns:
+        np.array:
+            An (occupied modes x 2) integer array of (mode, count) pairs
+    """
+
+    occupied, counts = np.unique(np.asarray(modes, dtype=np.intp),
+                                 return_counts=True)
+
+    return np.stack([occupied, counts], axis=1)
+
+
+def pairs_to_modes(pairs):
+    """Expand (mode, count) pairs of the occupied modes into a sorted
+    mode list, the inverse of `modes_to_pairs`.
+
+    Args:
+        pairs (np.array):
+            An (occupied modes x 2) integer array of (mode, count) pairs
+
+    Returns:
+        np.array:
+            The sorted mode list
+    """
+
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    order = np.argsort(pairs[:, 0])
+
+    return np.repeat(pairs[order, 0], pairs[order, 1])
+
+
+def gen_submatrix_from_modes(modes_in, modes_out, unitary_mat):
+    """Build the submatrix (or a stack of submatrices) whose permanent
+    gives the output probability directly from mode lists, at a cost
+    that depends only on the number of photons, not modes.
+
+    Args:
+        modes_in (np.array):
+            The mode list of the input photons
+        modes_out (np.array):
+            The mode list of the output photons, or a 2-D array with one
+            mode list per row
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+
+    Raises:
+        ValueError:
+            If the number of photons inputted do not equal the number
+            of photons output, a ValueError is raised.
+
+    Returns:
+        np.array:
+            The (photons x photons) submatrix, or a
+            (batch x photons x photons) stack of submatrices
+    """
+
+    modes_in = np.asarray(modes_in, dtype=np.intp)
+    modes_out = np.asarray(modes_out, dtype=np.intp)
+
+    if modes_out.shape[-1] != modes_in.shape[0]:
+        raise ValueError("Number of photons inputted is not equal "
+                         "to number outputted!")
+
+    return np.asarray(unitary_mat, dtype=np.cdouble)[
+        modes_out[..., :, None], modes_in[None, :]]
+
+
+def _mode_factorials(modes):
+    """Calculate the product of the factorials of the photon counts of
+    every mode, from sorted mode lists.
+
+    Within a run of equal modes the i-th photon contributes a factor i,
+    so the product over all photons is the product of count! over every
+    occupied mode.
+
+    Args:
+        modes (np.array):
+            A 2-D array with one sorted mode list per row
+
+    Returns:
+        np.array:
+            A 1-D float array with the factorial product of each row
+    """
+
+    position = np.ones(modes.shape, dtype=np.double)
+    for photon in range(1, modes.shape[1]):
+        position[:, photon] = np.where(
+            modes[:, photon] == modes[:, photon - 1],
+            position[:, photon - 1] + 1, 1)
+
+    return position.prod(axis=1)
+
+
+def output_probability_from_modes(modes_in, modes_out, unitary_mat,
+                                  backend=None):
+    """Calculate the probability of output configurations given as mode
+    lists, at a cost that depends only on the number of photons, not
+    modes.
+
+    Args:
+        modes_in (np.array):
+            The mode list of the input photons
+        modes_out (np.array):
+            The mode list of the output photons, or a 2-D array with one
+            mode list per row
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+
+    Returns:
+        float or np.array:
+            The probability, or a 1-D array with the probability of each
+            row of `modes_out`
+    """
+
+    modes_in = np.sort(np.asarray(modes_in, dtype=np.intp))
+    modes_out = np.asarray(modes_out, dtype=np.intp)
+    batch_modes_out = np.sort(np.atleast_2d(modes_out), axis=1)
+
+    probabilities = np.empty(batch_modes_out.shape[0], dtype=np.double)
+    for start in range(0, batch_modes_out.shape[0], _BATCH_SIZE):
+        chunk = batch_modes_out[start:start + _BATCH_SIZE]
+        sub_mats = gen_submatrix_from_modes(modes_in, chunk, unitary_mat)
+        probabilities[start:start + chunk.shape[0]] = (
+            np.abs(_permanents(sub_mats, backend))**2 /
+            (_mode_factorials(modes_in[None])[0] * _mode_factorials(chunk)))
+
+    if modes_out.ndim == 1:
+        return float(probabilities[0])
+
+    return probabilities
+
+
+def unrank_modes(index, num_photons, num_modes):
+    """Calculate the mode list of the output configuration at a given
+    rank (see `rank_configuration`) without building its dense
+    occupation, at a cost of O(photons) array operations.
+
+    Args:
+        index (int or np.array):
+            A single rank or a 1-D array of ranks
+        num_photons (int):
+            The total number of photons inputted into the system
+        num_modes (int):
+            The total number of modes photons can be present in
+
+    Raises:
+        ValueError:
+            If any rank is negative or not smaller than the number of
+            output configurations, a ValueError is raised.
+
+    Returns:
+        np.array:
+            The mode list at `index`, or a (ranks x photons) array of
+            mode lists if an array of ranks was given
+    """
+
+    table = _composition_table(num_photons, num_modes)
+    size = table[num_photons, num_modes]
+    scalar = np.ndim(index) == 0
+    index = np.atleast_1d(np.asarray(index, dtype=table.dtype))
+
+    if index.size and (index.min() < 0 or index.max() >= size):
+        raise ValueError("Configuration rank is out of range!")
+
+    # Ascending ranks of occupations are descending lexicographic mode
+    # lists, so work with the position among ascending mode lists.
+    # Mode lists whose photon `j` sits in a mode below v (with the same
+    # photons before it, the lowest being in mode `low`) telescope to
+    # table[k + 1, m - low] - table[k + 1, m - v] with k photons after j.
+    position = size - 1 - index
+    modes = np.empty((index.shape[0], num_photons), dtype=np.intp)
+    low = np.zeros(index.shape[0], dtype=np.intp)
+    for photon in range(num_photons):
+        counts = table[num_photons - photon]
+        left = np.searchsorted(counts, counts[num_modes - low] - position,
+                               side="left")
+        position -= counts[num_modes - low] - counts[left]
+        modes[:, photon] = num_modes - left
+        low = modes[:, photon]
+
+    if scalar:
+        return modes[0]
+
+    return modes
+
+
+def gen_output_mode_chunks(num_photons, num_modes, chunk_size=65536,
+                           start=0, stop=None, shard=None):
+    """Generate output photon configurations as chunks of mode lists, in
+    the same (rank) order as `gen_output_configuration_chunks` but
+    without ever building dense length `num_modes` occupations.
+
+    Args:
+        num_photons (int):
+            The total number of photons inputted into the system
+        num_modes (int):
+            The total number of modes photons can be present in
+        chunk_size (int, optional):
+            The maximum number of configurations per chunk.
+            Defaults to 65536.
+        start (int, optional):
+            Rank of the first configuration to generate. Defaults to 0.
+        stop (int, optional):
+            Rank one past the last configuration to generate. Defaults
+            to the number of output configurations.
+        shard ((int, int), optional):
+            An (index, count) pair. If given, only the `index`-th of
+            `count` contiguous, equally sized rank ranges between
+            `start` and `stop` is generated. Defaults to None.
+
+    Yields:
+        np.array:
+            A (chunk x num_photons) integer array of mode lists
+    """
+
+    if stop is None:
+        stop = num_output_configurations(num_photons, num_modes)
+    if shard is not None:
+        shard_start, shard_stop = shard_range(stop - start, *shard)
+        start, stop = start + shard_start, start + shard_stop
+
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        yield unrank_modes(np.arange(chunk_start, chunk_stop), num_photons,
+                           num_modes)
+
+
+def gbs_matrix(squeezing, unitary_mat):
+    """Calculate the symmetric matrix B = U diag(tanh r) U^T whose
+    hafnians give the output probabilities of Gaussian boson sampling,
+    where single-mode squeezed vacuum states with squeezing parameters r
+    enter the interferometer U. It only depends on the setup, so it is
+    calculated once and shared by every output configuration.
+
+    Args:
+        squeezing (float or [float]):
+            The squeezing parameter of every input mode or of each of
+            them (0 for vacuum)
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+
+    Returns:
+        np.array: The (modes x modes) complex symmetric matrix B
+    """
+
+    unitary_mat = np.asarray(unitary_mat, dtype=np.cdouble)
+    squeezing = np.broadcast_to(np.asarray(squeezing, dtype=np.double),
+                                (unitary_mat.shape[1],))
+
+    return (unitary_mat * np.tanh(squeezing)) @ unitary_mat.T
+
+
+def _perfect_matchings(size):
+    """Enumerate the perfect matchings of `size` (even) vertices, each
+    as a list of pairs.
+
+    Args:
+        size (int):
+            The number of vertices
+
+    Returns:
+        np.array:
+            A (matchings x size / 2 x 2) integer array with (size - 1)!!
+            matchings
+    """
+
+    matchings = [[]]
+    for _ in range(size // 2):
+        extended = []
+        for matching in matchings:
+            used = {vertex for pair in matching for vertex in pair}
+            free = [vertex for vertex in range(size) if vertex not in used]
+            extended.extend(matching + [(free[0], partner)]
+                            for partner in free[1:])
+        matchings = extended
+
+    return np.array(matchings, dtype=np.intp).reshape(len(matchings),
+                                                      size // 2, 2)
+
+
+def _hafnians(sub_mats):
+    """Calculate the hafnian of every matrix in a stack of symmetric
+    matrices of even size.
+
+    Up to 8 x 8, the (n - 1)!! perfect matchings are summed over for the
+    whole stack at once, larger matrices are handed to
+    `thewalrus.hafnian` one by one.
+
+    Args:
+        sub_mats (np.array):
+            A (batch x n x n) array of symmetric matrices
+
+    Returns:
+        np.array:
+            A 1-D complex array holding the hafnian of each matrix
+    """
+
+    size = sub_mats.shape[-1]
+    if size == 0:
+        return np.ones(sub_mats.shape[0], dtype=np.cdouble)
+
+    if size <= 8:
+        matchings = _perfect_matchings(size)
+        return sub_mats[:, matchings[..., 0], matchings[..., 1]].prod(
+            axis=2).sum(axis=1)
+
+    return np.array([thewalrus.hafnian(mat) for mat in sub_mats],
+                    dtype=np.cdouble)
+
+
+def gbs_batch_output_probability(squeezing, photons_out, unitary_mat,
+                                 cache=None):
+    """Calculate the probabilities of many output configurations of
+    Gaussian boson sampling, where single-mode squeezed vacuum states
+    enter the interferometer:
+
+        P(s) = |Haf(B_s)|^2 / (s! prod_j cosh r_j)
+
+    with B_s the `gbs_matrix` with row and column i repeated s_i times
+    (Hamilton et al., https://arxiv.org/abs/1612.01199). Outputs with an
+    odd number of photons have probability zero.
+
+    Args:
+        squeezing (float or [float]):
+            The squeezing parameter of every input mode or of each of
+            them (0 for vacuum)
+        photons_out (np.array):
+            A 2-D array with one output configuration per row
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        cache (ProbabilityCache, optional):
+            A cache probabilities are looked up in before and stored in
+            after being calculated, keyed by the `gbs_matrix`.
+            Defaults to None (no caching).
+
+    Returns:
+        np.array:
+            A 1-D float array with the probability of each row of
+            `photons_out`
+    """
+
+    photons_out = np.atleast_2d(np.asarray(photons_out, dtype=np.intp))
+    gbs_mat = gbs_matrix(squeezing, unitary_mat)
+
+    if cache is not None:
+        digest = unitary_digest(gbs_mat)
+        probabilities, missing = cache.lookup(digest, ["gbs"], photons_out)
+        if missing.any():
+            probabilities[missing] = gbs_batch_output_probability(
+                squeezing, photons_out[missing], unitary_mat)
+            cache.store(digest, ["gbs"], photons_out[missing],
+                        probabilities[missing])
+        return probabilities
+
+    call_start = _timer()
+
+    totals = photons_out.sum(axis=1)
+    hafnians = np.zeros(photons_out.shape[0], dtype=np.cdouble)
+    for total in np.unique(totals[totals % 2 == 0]):
+        rows = np.flatnonzero(totals == total)
+        for start in range(0, rows.shape[0], _BATCH_SIZE):
+            chunk = rows[start:start + _BATCH_SIZE]
+            modes = occupation_to_modes(photons_out[chunk])
+            hafnians[chunk] = _hafnians(
+                gbs_mat[modes[:, :, None], modes[:, None, :]])
+
+    squeezing = np.broadcast_to(np.asarray(squeezing, dtype=np.double),
+                                (gbs_mat.shape[0],))
+    probabilities = (np.abs(hafnians)**2 /
+                     (_factorial_products(photons_out) *
+                      np.cosh(squeezing).prod()))
+
+    _record("gbs_batch_output_probability", call_start,
+            photons_out.shape[0])
+
+    return probabilities
+
+
+def gbs_output_probability(squeezing, photons_out, unitary_mat, cache=None):
+    """Calculate the probability of a certain photon output
+    configuration of Gaussian boson sampling, see
+    `gbs_batch_output_probability`.
+
+    Args:
+        squeezing (float or [float]):
+            The squeezing parameter of every input mode or of each of
+            them (0 for vacuum)
+        photons_out ([int]):
+            A list with each integer entry representing the number
+            of individual photons at the ouptut modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        cache (ProbabilityCache, optional):
+            A cache probabilities are looked up in before and stored in
+            after being calculated. Defaults to None (no caching).
+
+    Returns:
+        float: probability photons will be detected in the given
+        `photons_out` configuration
+    """
+
+    return float(gbs_batch_output_probability(squeezing, [photons_out],
+                                              unitary_mat, cache)[0])
+
+
+def gbs_output_distribution(squeezing, unitary_mat, max_photons,
+                            return_configurations=False, chunk_size=4096,
+                            cache=None):
+    """Calculate the Gaussian boson sampling probability of every output
+    configuration with at most `max_photons` photons. Configurations
+    with an odd number of photons (probability zero) are skipped, the
+    others are ordered by their number of photons and, for the same
+    number, by rank (see `rank_configuration`).
+
+    Args:
+        squeezing (float or [float]):
+            The squeezing parameter of every input mode or of each of
+            them (0 for vacuum)
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        max_photons (int):
+            The largest number of photons in an output configuration
+        return_configurations (bool, optional):
+            Whether to also return the output configurations.
+            Defaults to False.
+        chunk_size (int, optional):
+            The number of configurations calculated per batch.
+            Defaults to 4096.
+        cache (ProbabilityCache, optional):
+            A cache probabilities are looked up in before and stored in
+            after being calculated. Defaults to None (no caching).
+
+    Returns:
+        np.array or (np.array, np.array):
+            The 1-D array of probabilities and, if requested, the
+            (configurations x modes) array of output configurations
+    """
+
+    num_modes = np.asarray(unitary_mat).shape[0]
+    chunks = [chunk for total in range(0, max_photons + 1, 2)
+              for chunk in gen_output_configuration_chunks(
+                  total, num_modes, chunk_size)]
+    probabilities = np.concatenate([
+        gbs_batch_output_probability(squeezing, chunk, unitary_mat, cache)
+        for chunk in chunks])
+
+    if return_configurations:
+        return probabilities, np.concatenate(chunks)
+
+    return probabilities
+
+
+def _column_deleted_permanents(mat):
+    """Calculate the permanents of every square matrix obtained by
+    deleting one column from a (k - 1 x k) matrix, using Ryser's formula
+    so that all k permanents share the same subset row sums.
+
+    The row sums of the subsets of the lowest columns are built once as
+    a table, one column at a time, while the remaining columns are
+    walked in Gray code order, so every subset costs O(k) and all k
+    permanents O(k 2^k) together.
+
+    Args:
+        mat (np.array):
+            A (k - 1 x k) matrix
+
+    Returns:
+        np.array:
+            A 1-D complex array whose entry `l` is the permanent of
+            `mat` with column `l` removed
+    """
+
+    num_rows, num_cols = mat.shape
+    num_low = min(num_cols, 12)
+    num_high = num_cols - num_low
+
+    # Ryser's formula sums over column subsets S, the permanent with
+    # column l deleted only uses the subsets that do not contain l.
+    # Doubling the table adds column j to every subset of bit j.
+    low_sums = np.zeros((1, num_rows), dtype=np.cdouble)
+    for col in range(num_low):
+        low_sums = np.concatenate([low_sums, low_sums + mat[:, col]])
+    low_bits = (np.arange(1 << num_low)[:, None] >> np.arange(num_low)) & 1
+    low_signs = (-1.0)**low_bits.sum(axis=1)
+    low_absent = (1 - low_bits).T.astype(np.double)
+
+    minors = np.zeros(num_cols, dtype=np.cdouble)
+    high_sums = np.zeros(num_rows, dtype=np.cdouble)
+    high_absent = np.ones(num_high)
+    high_sign = 1.0
+    high_code = 0
+    for step in range(1 << num_high):
+        if step:
+            # The next Gray code flips the lowest set bit of `step`
+            flip = (step & -step).bit_length() - 1
+            high_code ^= 1 << flip
+            high_sign = -high_sign
+            if high_code >> flip & 1:
+                high_sums += mat[:, num_low + flip]
+            else:
+                high_sums -= mat[:, num_low + flip]
+            high_absent[flip] = 1 - (high_code >> flip & 1)
+        terms = high_sign * low_signs * np.prod(low_sums + high_sums, axis=1)
+        minors[:num_low] += low_absent @ terms
+        minors[num_low:] += high_absent * terms.sum()
+
+    return (-1)**num_rows * minors
+
+
+def sample(photons_in, unitary_mat, shots=1, rng=None, overlap=None,
+           transmission=None):
+    """Draw output photon configurations from the exact output
+    distribution of the interferometer using Clifford & Clifford's
+    boson sampling algorithm (https://arxiv.org/abs/1706.01260), which
+    costs O(n 2^n) per sample instead of enumerating every output
+    probability (step k of a sample evaluates k permanents of
+    (k - 1 x k - 1) matrices together in O(k 2^k), see
+    `_column_deleted_permanents`).
+
+    Partially distinguishable photons whose internal states all overlap
+    by x behave like a mixture: every photon independently interferes
+    with probability x and is otherwise fully distinguishable (the
+    model behind the expansion of Renema et al.). Each sample draws the
+    interfering photons, samples them with Clifford & Clifford and
+    places the others independently, at an expected O(xn 2^(xn)) cost.
+
+    With loss, the surviving photons are drawn first (each photon
+    independently, with the transmission of its input mode) and only
+    those are sampled.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        shots (int, optional):
+            The number of samples to draw. Defaults to 1.
+        rng (np.random.Generator or int, optional):
+            A random number generator or a seed for one.
+            Defaults to None (fresh, unseeded generator).
+        overlap (float, optional):
+            The overlap |<psi_i|psi_j>| of the internal states of every
+            pair of input photons. Defaults to None (indistinguishable
+            photons).
+        transmission (float or [float], optional):
+            The probability a photon entering the interferometer is not
+            lost, for every input mode or for each of them. Defaults to
+            None (no loss).
+
+    Raises:
+        ValueError:
+            If `overlap` is not a number between 0 and 1 or the
+            transmission is invalid, a ValueError is raised.
+
+    Returns:
+        np.array:
+            A (shots x modes) integer array with one sampled output
+            configuration per row
+    """
+
+    rng = np.random.default_rng(rng)
+    unitary_mat = np.asarray(unitary_mat, dtype=np.cdouble)
+    photons = _photon_indices(photons_in)
+    num_modes = unitary_mat.shape[0]
+
+    if overlap is not None and not (np.ndim(overlap) == 0 and
+                                    0 <= overlap <= 1):
+        raise ValueError("Overlap must be between 0 and 1!")
+    if transmission is not None:
+        transmission = _transmission_vector(transmission, len(photons_in))
+
+    samples = np.zeros((shots, num_modes), dtype=np.intp)
+    for shot in range(shots):
+        col_idx = photons
+        if transmission is not None:
+            col_idx = col_idx[rng.random(col_idx.shape[0]) <
+                              transmission[col_idx]]
+        if overlap is not None:
+            interfering = rng.random(col_idx.shape[0]) < overlap
+            # Distinguishable photons leave through mode i with
+            # probability |U_ij|^2, independently of each other
+            for col in col_idx[~interfering]:
+                samples[shot, rng.choice(num_modes, p=np.abs(
+                    unitary_mat[:, col])**2)] += 1
+            col_idx = col_idx[interfering]
+
+        # Randomly permuting the photons lets the algorithm draw one
+        # output mode per photon from the marginal of the photons
+        # placed so far
+        col_mat = unitary_mat[:, rng.permutation(col_idx)]
+
+        rows = []
+        for k in range(1, col_idx.shape[0] + 1):
+            # Laplace expansion of the permanent of the k x k submatrix
+            # along its newest row, evaluated for every candidate row
+            minors = _column_deleted_permanents(col_mat[rows, :k])
+            weights = np.abs(col_mat[:, :k] @ minors)**2
+            rows.append(rng.choice(num_modes, p=weights / weights.sum()))
+
+        samples[shot] += np.bincount(rows, minlength=num_modes)
+
+    return samples
+
+
+def _binomial_estimate(successes, trials, confidence):
+    """Estimate a probability from the number of successes in repeated
+    trials, with a Wilson score confidence interval.
+
+    Args:
+        successes (int):
+            The number of successful trials
+        trials (int):
+            The total number of trials
+        confidence (float):
+            The confidence level of the interval, e.g. 0.95
+
+    Returns:
+        Estimate: The estimated probability
+    """
+
+    value = successes / trials
+    stderr = math.sqrt(value * (1 - value) / trials)
+    z = sp.stats.norm.ppf(0.5 + confidence / 2)
+
+    center = (value + z**2 / (2 * trials)) / (1 + z**2 / trials)
+    half_width = (z / (1 + z**2 / trials) *
+                  math.sqrt(value * (1 - value) / trials +
+                            z**2 / (4 * trials**2)))
+
+    return Estimate(value, stderr, max(0.0, float(center - half_width)),
+                    min(1.0, float(center + half_width)))
+
+
+def bunching_probability(photons_in, unitary_mat, modes, backend=None):
+    """Calculate the probability that every photon leaves the
+    interferometer in the given subset of output modes, without
+    enumerating any output configuration.
+
+    With A the (modes x photons) matrix of the unitary restricted to
+    `modes` and the input photons, the probability is the permanent of
+    the photons x photons Gram matrix A^dagger A divided by the input
+    factorials (Shchesnovich, https://arxiv.org/abs/1509.01561).
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        modes ([int]):
+            The indices of the output modes
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+
+    Returns:
+        float: probability all photons are detected in `modes`
+    """
+
+    col_mat = np.asarray(unitary_mat, dtype=np.cdouble)[
+        np.asarray(modes, dtype=np.intp)][:, _photon_indices(photons_in)]
+    gram = col_mat.conj().T @ col_mat
+
+    return float(permanent(gram, backend).real /
+                 sp.special.factorial(photons_in).prod())
+
+
+def _marginal_subsets(photons_in, num_photons):
+    """Enumerate the distinct ways of choosing `num_photons` of the
+    input photons, as multisets of input modes.
+
+    Photons entering the same mode give identical columns, so choices
+    that only differ in which of them is picked give identical terms and
+    are merged, weighted by how often they occur (the product of the
+    binomials C(t_j, u_j)).
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        num_photons (int):
+            The number of photons to choose
+
+    Returns:
+        (np.array, np.array, np.array):
+            A (subsets x num_photons) array with the input mode of each
+            chosen photon, a (subsets x remaining photons) array with
+            the input modes of the photons not chosen, and the 1-D float
+            array of weights
+    """
+
+    counts = collections.Counter(
+        itertools.combinations(_photon_indices(photons_in), num_photons))
+    chosen = np.array(list(counts), dtype=np.intp).reshape(len(counts),
+                                                            num_photons)
+    remaining = occupation_to_modes(
+        np.asarray(photons_in, dtype=np.intp) -
+        modes_to_occupation(chosen, len(photons_in)))
+
+    return (chosen, remaining.reshape(len(counts), -1),
+            np.array(list(counts.values()), dtype=np.double))
+
+
+def _marginal_gram_permanents(remaining, gram, backend=None):
+    """Calculate the permanents of the Gram matrix of the unobserved
+    modes restricted to every pair of remaining photon sets.
+
+    Only the upper triangle is calculated, as swapping the pair
+    conjugates the permanent of a Hermitian matrix's submatrix.
+
+    Args:
+        remaining (np.array):
+            A (subsets x photons) array with the input modes of each set
+            of remaining photons
+        gram (np.array):
+            The (input modes x input modes) Gram matrix of the
+            unobserved output modes
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+
+    Returns:
+        np.array:
+            A (subsets x subsets) Hermitian matrix of permanents
+    """
+
+    num_subsets, num_photons = remaining.shape
+    if num_photons == 0:
+        return np.ones((num_subsets, num_subsets), dtype=np.cdouble)
+
+    rows, cols = np.triu_indices(num_subsets)
+    perms = np.empty(rows.shape[0], dtype=np.cdouble)
+    for start in range(0, rows.shape[0], _BATCH_SIZE):
+        stop = start + _BATCH_SIZE
+        perms[start:stop] = _permanents(
+            gram[remaining[rows[start:stop], :, None],
+                 remaining[cols[start:stop], None, :]], backend)
+
+    table = np.empty((num_subsets, num_subsets), dtype=np.cdouble)
+    table[rows, cols] = perms
+    table[cols, rows] = perms.conj()
+
+    return table
+
+
+def marginal_probability(photons_in, partial_out, modes, unitary_mat,
+                         backend=None):
+    """Calculate the probability of observing a partial output pattern
+    on a subset of the output modes, whatever happens in the others,
+    without summing over the completions of the pattern.
+
+    Laplace-expanding the permanent over the k observed photons and
+    summing the unobserved modes out with the Cauchy-Binet formula for
+    permanents gives
+
+        P(s_K) = sum over k-subsets S, S' of the input photons of
+                 conj(Per(M[r, S])) Per(M[r, S']) Per(H[S^c, S'^c])
+                 / (s_K! t!)
+
+    where M holds the columns of the input photons, r repeats each
+    observed mode by its photon count and H is the Gram matrix M^dagger
+    M restricted to the unobserved output modes. The Gram permanents
+    only depend on the observed modes and k, so they are calculated
+    once and shared by every pattern with the same number of photons.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        partial_out ([int]):
+            The number of photons observed in each of `modes`, or a 2-D
+            array with one such pattern per row
+        modes ([int]):
+            The indices of the (distinct) observed output modes
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+
+    Raises:
+        ValueError:
+            If the modes are not distinct, a pattern does not match the
+            number of modes or a pattern holds more photons than were
+            inputted, a ValueError is raised.
+
+    Returns:
+        float or np.array:
+            The marginal probability, or a 1-D array with the marginal
+            probability of each row of `partial_out`
+    """
+
+    unitary_mat = np.asarray(unitary_mat, dtype=np.cdouble)
+    photons_in = np.asarray(photons_in, dtype=np.intp)
+    modes = np.asarray(modes, dtype=np.intp)
+    partial_out = np.asarray(partial_out, dtype=np.intp)
+    patterns = np.atleast_2d(partial_out)
+    photon_count = int(photons_in.sum())
+
+    if np.unique(modes).shape[0] != modes.shape[0]:
+        raise ValueError("Marginal modes must be distinct!")
+    if patterns.shape[1] != modes.shape[0]:
+        raise ValueError("Partial output does not match the number "
+                         "of marginal modes!")
+    if np.any(patterns.sum(axis=1) > photon_count):
+        raise ValueError("Number of photons in the partial output "
+                         "exceeds number inputted!")
+
+    unobserved = np.setdiff1d(np.arange(unitary_mat.shape[0]), modes)
+    gram = unitary_mat[unobserved].conj().T @ unitary_mat[unobserved]
+    input_factorials = sp.special.factorial(photons_in).prod()
+
+    probabilities = np.empty(patterns.shape[0], dtype=np.double)
+    totals = patterns.sum(axis=1)
+    for num_photons in np.unique(totals):
+        chosen, remaining, weights = _marginal_subsets(photons_in,
+                                                       num_photons)
+        gram_perms = _marginal_gram_permanents(remaining, gram, backend)
+
+        for pattern in np.flatnonzero(totals == num_photons):
+            rows = modes[_photon_indices(patterns[pattern])]
+            if num_photons:
+                perms = _permanents(unitary_mat[rows][:, chosen]
+                                    .transpose(1, 0, 2), backend)
+            else:
+                perms = np.ones(chosen.shape[0], dtype=np.cdouble)
+            perms *= weights
+            probabilities[pattern] = (
+                (perms.conj() @ gram_perms @ perms).real /
+                (sp.special.factorial(patterns[pattern]).prod() *
+                 input_factorials))
+
+    if partial_out.ndim == 1:
+        return float(probabilities[0])
+
+    return probabilities
+
+
+def marginal_distribution(photons_in, modes, unitary_mat,
+                          return_configurations=False, backend=None):
+    """Calculate the marginal distribution of the photon counts in a
+    subset of the output modes.
+
+    Patterns are ordered by their number of photons and, for the same
+    number, by rank (see `rank_configuration`).
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        modes ([int]):
+            The indices of the (distinct) observed output modes
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        return_configurations (bool, optional):
+            Whether to also return the partial output patterns.
+            Defaults to False.
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+
+    Returns:
+        np.array or (np.array, np.array):
+            The 1-D array of marginal probabilities and, if requested,
+            the (patterns x modes) array of partial output patterns
+    """
+
+    num_modes = len(modes)
+    patterns = np.concatenate(
+        [np.concatenate(list(gen_output_configuration_chunks(
+            num_photons, num_modes)))
+         for num_photons in range(int(np.sum(photons_in)) + 1)])
+    probabilities = marginal_probability(photons_in, patterns, modes,
+                                         unitary_mat, backend)
+
+    if return_configurations:
+        return probabilities, patterns
+
+    return probabilities
+
+
+def binned_distribution(photons_in, unitary_mat, bins, backend=None):
+    """Calculate the distribution of the number of photons detected in
+    each of a few bins (groups of output modes) without enumerating any
+    output configuration.
+
+    The characteristic function of the bin counts at phases phi is the
+    permanent of M^dagger D(phi) M divided by the input factorials,
+    where M holds the columns of the input photons and D(phi) multiplies
+    the rows of every bin by its phase (Shchesnovich,
+    https://arxiv.org/abs/1904.02013). Sampling it on the (n + 1)^B grid
+    of phases 2 pi q / (n + 1) and taking a discrete Fourier transform
+    gives the distribution exactly, from (n + 1)^B permanents of n x n
+    matrices. When the bins cover every mode the last bin count is
+    fixed by the others and the grid shrinks to (n + 1)^(B - 1).
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        bins ([[int]]):
+            A list of disjoint lists of output modes. Modes in no bin
+            are summed over.
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+
+    Raises:
+        ValueError:
+            If the bins are not disjoint, a ValueError is raised.
+
+    Returns:
+        np.array:
+            An (n + 1) x ... x (n + 1) array (one axis per bin) whose
+            entry [n_1, ..., n_B] is the probability of detecting n_b
+            photons in bin b
+    """
+
+    unitary_mat = np.asarray(unitary_mat, dtype=np.cdouble)
+    photon_count = int(np.sum(photons_in))
+    bins = [np.asarray(modes, dtype=np.intp) for modes in bins]
+    binned = np.concatenate(bins) if bins else np.zeros(0, dtype=np.intp)
+
+    if np.unique(binned).shape[0] != binned.shape[0]:
+        raise ValueError("Bins must be disjoint!")
+
+    col_mat = unitary_mat[:, _photon_indices(photons_in)]
+    grams = np.array([col_mat[modes].conj().T @ col_mat[modes]
+                      for modes in bins]).reshape(len(bins), photon_count,
+                                                  photon_count)
+    unbinned = np.setdiff1d(np.arange(unitary_mat.shape[0]), binned)
+    offset = col_mat[unbinned].conj().T @ col_mat[unbinned]
+
+    # With every mode binned, the phase of the last bin can be fixed to
+    # zero (its count being the photons missing from the others).
+    phased = len(bins) - 1 if unbinned.shape[0] == 0 else len(bins)
+    if phased < len(bins):
+        offset = offset + grams[-1]
+    grid_shape = (photon_count + 1,) * phased
+    grid = np.indices(grid_shape).reshape(phased,
+                                          math.prod(grid_shape)).T
+
+    # The characteristic function at -q is the conjugate of that at q,
+    # so only one of each pair of grid points is calculated.
+    mirror = np.zeros(1, dtype=np.intp)
+    if phased:
+        mirror = np.ravel_multi_index((-grid % (photon_count + 1)).T,
+                                      grid_shape)
+    points = np.flatnonzero(np.arange(grid.shape[0]) <= mirror)
+
+    characteristic = np.empty(grid.shape[0], dtype=np.cdouble)
+    for start in range(0, points.shape[0], _BATCH_SIZE):
+        chunk = points[start:start + _BATCH_SIZE]
+        phases = np.exp(2j * np.pi * grid[chunk] / (photon_count + 1))
+        mats = offset + np.einsum("gb,bij->gij", phases, grams[:phased])
+        characteristic[chunk] = _permanents(mats, backend)
+    characteristic[mirror[points]] = characteristic[points].conj()
+    characteristic /= sp.special.factorial(photons_in).prod()
+
+    probabilities = np.fft.fftn(characteristic.reshape(grid_shape)).real
+    probabilities /= characteristic.shape[0]
+
+    if phased == len(bins):
+        return probabilities
+
+    # Put the last bin count back, keeping only consistent totals.
+    distribution = np.zeros((photon_count + 1,) * len(bins))
+    last = photon_count - grid.sum(axis=1)
+    valid = last >= 0
+    distribution[tuple(grid[valid].T) + (last[valid],)] = (
+        probabilities.ravel()[valid])
+
+    return distribution
+
+
+def collision_probability(photons_in, unitary_mat, shots=10000,
+                          confidence=0.95, max_exact=100000, rng=None,
+                          backend=None):
+    """Calculate the probability of a "collision", an output
+    configuration with more than one photon in some mode.
+
+    The probability is exact for two photons (the sum of the single
+    mode bunching probabilities) and whenever the number of
+    collision-free output configurations is at most `max_exact` (one
+    minus the sum of their probabilities). Otherwise it is estimated
+    from output configurations drawn with `sample`.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        shots (int, optional):
+            The number of samples drawn when estimating.
+            Defaults to 10000.
+        confidence (float, optional):
+            The confidence level of the interval when estimating.
+            Defaults to 0.95.
+        max_exact (int, optional):
+            The maximum number of collision-free output configurations
+            summed over for an exact result. Defaults to 100000.
+        rng (np.random.Generator or int, optional):
+            A random number generator or a seed for one.
+            Defaults to None (fresh, unseeded generator).
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+
+    Returns:
+        Estimate: The collision probability
+    """
+
+    photon_count = int(np.sum(photons_in))
+    num_modes = len(photons_in)
+
+    if photon_count < 2:
+        return Estimate(0.0, 0.0, 0.0, 0.0)
+
+    if photon_count == 2:
+        # Both photons in mode i has probability
+        # 2 |U_i,a|^2 |U_i,b|^2 / (input factorials)
+        col_mat = np.asarray(unitary_mat,
+                             dtype=np.cdouble)[:, _photon_indices(photons_in)]
+        value = float(2 * np.prod(np.abs(col_mat)**2, axis=1).sum() /
+                      sp.special.factorial(photons_in).prod())
+        return Estimate(value, 0.0, value, value)
+
+    if math.comb(num_modes, photon_count) <= max_exact:
+        occupied = np.array(list(itertools.combinations(range(num_modes),
+                                                        photon_count)),
+                            dtype=np.intp).reshape(-1, photon_count)
+        collision_free = np.zeros((occupied.shape[0], num_modes),
+                                  dtype=np.intp)
+        np.put_along_axis(collision_free, occupied, 1, axis=1)
+        value = 1 - batch_output_probability(photons_in, collision_free,
+                                             unitary_mat, backend).sum()
+        value = min(1.0, max(0.0, float(value)))
+        return Estimate(value, 0.0, value, value)
+
+    samples = sample(photons_in, unitary_mat, shots, rng)
+
+    return _binomial_estimate(int((samples.max(axis=1) > 1).sum()), shots,
+                              confidence)
+
+
+def random_unitaries(num_modes, count=1, rng=None):
+    """Draw unitary matrices from the Haar measure (uniformly random
+    interferometers) by QR-decomposing a stack of complex Gaussian
+    matrices and correcting the phases of the Q factors (Mezzadri,
+    https://arxiv.org/abs/math-ph/0609050).
+
+    Args:
+        num_modes (int):
+            The number of modes of each interferometer
+        count (int, optional):
+            The number of unitary matrices. Defaults to 1.
+        rng (np.random.Generator or int, optional):
+            A random number generator or a seed for one.
+            Defaults to None (fresh, unseeded generator).
+
+    Returns:
+        np.array:
+            A (count x num_modes x num_modes) array of unitary matrices
+    """
+
+    rng = np.random.default_rng(rng)
+    shape = (count, num_modes, num_modes)
+    gaussian = (rng.standard_normal(shape) +
+                1j * rng.standard_normal(shape)) / math.sqrt(2)
+    q_mats, r_mats = np.linalg.qr(gaussian)
+
+    # QR is only unique up to the phases of the diagonal of R, fixing
+    # them to be positive makes Q Haar distributed
+    diagonals = np.diagonal(r_mats, axis1=1, axis2=2)
+
+    return q_mats * (diagonals / np.abs(diagonals))[:, None, :]
+
+
+def _ensemble_statistic(statistic, photons_in, unitary_mat):
+    """Evaluate a statistic for one interferometer of an ensemble,
+    reducing an `Estimate` to its value.
+
+    Args:
+        statistic (callable):
+            A function of (photons_in, unitary_mat) returning a number
+            or an `Estimate`
+        photons_in ([int]):
+            The input photon configuration
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+
+    Returns:
+        float: The value of the statistic
+    """
+
+    value = statistic(photons_in, unitary_mat)
+    if isinstance(value, Estimate):
+        value = value.value
+
+    return float(value)
+
+
+def ensemble_average(statistic, photons_in, num_modes, count, workers=None,
+                     confidence=0.95, rng=None, block_size=256):
+    """Average a statistic of the interferometer, such as
+    `collision_probability`, over an ensemble of Haar random
+    interferometers drawn with `random_unitaries`.
+
+    Args:
+        statistic (callable):
+            A function of (photons_in, unitary_mat) returning a number
+            or an `Estimate` (whose value is used). It must be defined
+            at module level if `workers` is given, so it can be sent to
+            the worker processes.
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        num_modes (int):
+            The number of modes of each interferometer
+        count (int):
+            The number of interferometers averaged over
+        workers (int, optional):
+            The number of worker processes the interferometers are
+            split over. Defaults to None (no process pool).
+        confidence (float, optional):
+            The confidence level of the interval. Defaults to 0.95.
+        rng (np.random.Generator or int, optional):
+            A random number generator or a seed for one, used to draw
+            the interferometers. Defaults to None (fresh, unseeded
+            generator).
+        block_size (int, optional):
+            The number of interferometers drawn at a time, bounding
+            memory usage. Defaults to 256.
+
+    Returns:
+        Estimate:
+            The ensemble mean with its standard error and a normal
+            confidence interval
+    """
+
+    rng = np.random.default_rng(rng)
+    values = []
+
+    pool = None
+    if workers is not None and workers > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    try:
+        for start in range(0, count, block_size):
+            unitaries = random_unitaries(num_modes,
+                                         min(block_size, count - start), rng)
+            if pool is None:
+                values.extend(_ensemble_statistic(statistic, photons_in,
+                                                  unitary_mat)
+                              for unitary_mat in unitaries)
+            else:
+                values.extend(pool.map(
+                    _ensemble_statistic, itertools.repeat(statistic),
+                    itertools.repeat(photons_in), unitaries,
+                    chunksize=max(1, len(unitaries) // (4 * workers))))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    values = np.array(values)
+    mean = float(values.mean())
+    stderr = 0.0
+    if count > 1:
+        stderr = float(values.std(ddof=1) / math.sqrt(count))
+    z = sp.stats.norm.ppf(0.5 + confidence / 2)
+
+    return Estimate(mean, stderr, float(mean - z * stderr),
+                    float(mean + z * stderr))
+
+
+def _distinguishable_probabilities(photons_in, photons_out, unitary_mat,
+                                   backend=None):
+    """Calculate the probabilities of output configurations for fully
+    distinguishable photons, Per(|M|^2) / (s! t!) with M the submatrix
+    `gen_submatrices` builds.
+
+    Args:
+        photons_in ([int]):
+            The input photon configuration
+        photons_out (np.array):
+            A 2-D array with one output configuration per row
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+
+    Returns:
+        np.array:
+            A 1-D float array with the probability of each row of
+            `photons_out`
+    """
+
+    photons_out = np.atleast_2d(np.asarray(photons_out, dtype=np.intp))
+    permanents = np.concatenate([np.zeros(0)] + [
+        _permanents(np.abs(gen_submatrices(
+            photons_in, photons_out[start:start + _BATCH_SIZE],
+            unitary_mat))**2, backend).real
+        for start in range(0, photons_out.shape[0], _BATCH_SIZE)])
+
+    return permanents / (
+        _factorial_products(np.atleast_2d(np.asarray(photons_in,
+                                                     dtype=np.intp))) *
+        _factorial_products(photons_out))
+
+
+def _log_ratio_estimate(ideal, alternative, counts, confidence):
+    """Estimate the mean log-likelihood ratio per sample of the ideal
+    model over an alternative one.
+
+    Args:
+        ideal (np.array):
+            The ideal probability of each distinct sample
+        alternative (np.array):
+            The alternative probability of each distinct sample
+        counts (np.array):
+            How often each distinct sample occurred
+        confidence (float):
+            The confidence level of the interval
+
+    Returns:
+        Estimate: The mean log-likelihood ratio
+    """
+
+    with np.errstate(divide="ignore"):
+        ratios = np.log(ideal) - np.log(alternative)
+    trials = int(counts.sum())
+    mean = float(counts @ ratios / trials)
+    stderr = 0.0
+    if trials > 1:
+        variance = counts @ (ratios - mean)**2 / (trials - 1)
+        stderr = float(math.sqrt(variance / trials))
+    z = sp.stats.norm.ppf(0.5 + confidence / 2)
+
+    return Estimate(mean, stderr, float(mean - z * stderr),
+                    float(mean + z * stderr))
+
+
+def validate(samples, photons_in, unitary_mat,
+             tests=("uniform", "distinguishable", "heavy_output", "binned"),
+             bins=None, reference_size=10000, confidence=0.95,
+             backend=None, workers=None, cache=None, rng=None):
+    """Check samples of output configurations against the ideal boson
+    sampling model.
+
+    Repeated samples are only evaluated once, and the ideal
+    probabilities of all distinct samples are calculated in batches
+    (split over `workers` processes if given). The available tests are
+
+    - "uniform" and "distinguishable": the mean log-likelihood ratio per
+      sample of the ideal model over uniformly random outputs or over
+      fully distinguishable photons. It is positive if the samples
+      favor the ideal model.
+    - "heavy_output": the fraction of samples whose ideal probability
+      exceeds the median ideal probability of all outputs (about
+      (1 + ln 2) / 2 for ideal samples of a Haar random interferometer,
+      1 / 2 for uniform ones). The median is estimated from
+      `reference_size` uniformly random outputs unless there are fewer
+      outputs than that.
+    - "binned": a chi-squared test of the photon counts per bin against
+      `binned_distribution`, lumping together the bin counts expected
+      fewer than 5 times.
+
+    Args:
+        samples (np.array):
+            A (samples x modes) integer array of output configurations,
+            e.g. as returned by `sample`
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        tests ([str], optional):
+            The tests to run. Defaults to all of them.
+        bins ([[int]], optional):
+            The bins of output modes of the "binned" test. Defaults to
+            the two halves of the modes.
+        reference_size (int, optional):
+            The number of random outputs the heavy output median is
+            estimated from. Defaults to 10000.
+        confidence (float, optional):
+            The confidence level of the intervals. Defaults to 0.95.
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `set_permanent_backend`.
+        workers (int, optional):
+            The number of worker processes permanents are split over.
+            Defaults to None (no process pool).
+        cache (ProbabilityCache, optional):
+            A cache ideal probabilities are looked up in before and
+            stored in after being calculated. Defaults to None (no
+            caching).
+        rng (np.random.Generator or int, optional):
+            A random number generator or a seed for one, used to draw
+            the heavy output reference. Defaults to None (fresh,
+            unseeded generator).
+
+    Raises:
+        ValueError:
+            If an unknown test is requested, a ValueError is raised.
+
+    Returns:
+        dict:
+            The result of each test by name: an `Estimate` for
+            "uniform", "distinguishable" and "heavy_output", and a dict
+            with the "statistic", "dof" and "p_value" for "binned"
+    """
+
+    unknown = set(tests) - {"uniform", "distinguishable", "heavy_output",
+                            "binned"}
+    if unknown:
+        raise ValueError("Unknown validation test {0}!"
+                         .format(", ".join(sorted(unknown))))
+
+    rng = np.random.default_rng(rng)
+    samples = np.atleast_2d(np.asarray(samples, dtype=np.intp))
+    photon_count = int(np.sum(photons_in))
+    num_modes = samples.shape[1]
+    distinct, counts = np.unique(samples, axis=0, return_counts=True)
+
+    results = {}
+    if {"uniform", "distinguishable", "heavy_output"} & set(tests):
+        ideal = batch_output_probability(photons_in, distinct, unitary_mat,
+                                         backend, workers, cache)
+
+    if "uniform" in tests:
+        results["uniform"] = _log_ratio_estimate(
+            ideal, 1 / num_output_configurations(photon_count, num_modes),
+            counts, confidence)
+
+    if "distinguishable" in tests:
+        if workers is not None and workers > 1:
+            chunks = np.array_split(distinct, min(workers * 4,
+                                                  distinct.shape[0]))
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers) as pool:
+                distinguishable = np.concatenate(list(pool.map(
+                    _distinguishable_probabilities,
+                    itertools.repeat(photons_in), chunks,
+                    itertools.repeat(unitary_mat),
+                    itertools.repeat(backend))))
+        else:
+            distinguishable = _distinguishable_probabilities(
+                photons_in, distinct, unitary_mat, backend)
+        results["distinguishable"] = _log_ratio_estimate(
+            ideal, distinguishable, counts, confidence)
+
+    if "heavy_output" in tests:
+        size = num_output_configurations(photon_count, num_modes)
+        if size <= reference_size:
+            reference = output_distribution(photons_in, unitary_mat,
+                                            backend=backend,
+                                            workers=workers)
+        else:
+            if size < 2**63:
+                ranks = rng.integers(0, size, reference_size)
+            else:
+                ranks = np.array([int(rng.random() * size)
+                                  for _ in range(reference_size)],
+                                 dtype=object)
+            reference = batch_output_probability(
+                photons_in,
+                unrank_configuration(ranks, photon_count, num_modes),
+                unitary_mat, backend, workers, cache)
+        heavy = ideal > np.median(reference)
+        results["heavy_output"] = _binomial_estimate(
+            int(counts[heavy].sum()), int(counts.sum()), confidence)
+
+    if "binned" in tests:
+        if bins is None:
+            bins = np.array_split(np.arange(num_modes), 2)
+        expected = binned_distribution(photons_in, unitary_mat, bins,
+                                       backend).ravel()
+        bin_counts = np.stack([samples[:, modes].sum(axis=1)
+                               for modes in bins], axis=1)
+        observed = np.bincount(
+            np.ravel_multi_index(bin_counts.T,
+                                 (photon_count + 1,) * len(bins)),
+            minlength=expected.shape[0])
+        expected = np.clip(expected, 0, None) * samples.shape[0]
+
+        # Bin counts expected too rarely for the chi-squared
+        # approximation are merged into a single cell
+        rare = expected < 5
+        observed = np.r_[observed[~rare], observed[rare].sum()]
+        expected = np.r_[expected[~rare], expected[rare].sum()]
+        kept = expected > 0
+        statistic = float(((observed[kept] - expected[kept])**2 /
+                           expected[kept]).sum())
+        dof = max(1, int(kept.sum()) - 1)
+        results["binned"] = {"statistic": statistic, "dof": dof,
+                             "p_value": float(sp.stats.chi2.sf(statistic,
+                                                               dof))}
+
+    return results
+
+
+def precision_check(photons_in, unitary_mat, precision="single",
+                    samples=1000, backend=None, rng=None):
+    """Measure how far output probabilities calculated in a reduced (or
+    extended) precision are from the double precision ones, on random
+    output configurations.
+
+    Args:
+        photons_in ([int]):
+            A list with each integer entry representing the number
+            of individual photons in the input modes for the
+            interferometer
+        unitary_mat (np.array):
+            A unitary matrix describing an interferometer
+        precision (str, optional):
+            The precision to check, "single", "double" or "extended".
+            Defaults to "single".
+        samples (int, optional):
+            The number of uniformly random output configurations
+            compared (every configuration if there are fewer).
+            Defaults to 1000.
+        backend (str, optional):
+            The name of the permanent backend (or "auto") of the double
+            precision reference. Defaults to the backend selected with
+            `set_permanent_backend`.
+        rng (np.random.Generator or int, optional):
+            A random number generator or a seed for one, used to draw
+            the output configurations. Defaults to None (fresh,
+            unseeded generator).
+
+    Raises:
+        ValueError:
+            If the precision is unknown, a ValueError is raised.
+
+    Returns:
+        dict:
+            The "max_abs_error", "max_rel_error" and "median_rel_error"
+            of the probabilities in `precision`, and the
+            "configurations" compared
+    """
+
+    _precision_dtype(precision)
+    rng = np.random.default_rng(rng)
+    photon_count = int(np.sum(photons_in))
+    num_modes = unitary_mat.shape[0]
+
+    size = num_output_configurations(photon_count, num_modes)
+    if size <= samples:
+        photons_out = unrank_configuration(np.arange(size), photon_count,
+                                           num_modes)
+    else:
+        if size < 2**63:
+            ranks = rng.integers(0, size, samples)
+        else:
+            ranks = np.array([int(rng.random() * size)
+                              for _ in range(samples)], dtype=object)
+        photons_out = unrank_configuration(ranks, photon_count, num_modes)
+
+    reference = batch_output_probability(photons_in, photons_out,
+                                         unitary_mat, backend)
+    probabilities = batch_output_probability(photons_in, photons_out,
+                                             unitary_mat, backend,
+                                             precision=precision)
+
+    abs_error = np.abs(probabilities - reference)
+    # Outputs that are (numerically) suppressed have no meaningful
+    # relative error
+    significant = reference > np.finfo(np.double).eps * reference.max()
+    rel_error = abs_error[significant] / reference[significant]
+
+    return {"max_abs_error": float(abs_error.max()),
+            "max_rel_error": float(rel_error.max()),
+            "median_rel_error": float(np.median(rel_error)),
+            "configurations": photons_out.shape[0]}
@@ -0,0 +1,511 @@
+# Boson Sampling Library - A library to help better understand Aaronson-Arkhipov Boson Sampling (AABS)
+# Copyright (C) 2021  If and Only If (Iff) Technologies
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+## Module Description:
+
+# An optional local probability service, so several processes can
+# share the interferometers they query instead of each recomputing
+# `output_probability`. Start it with
+#
+#   python -m bosonsampling_server --socket /tmp/bosonsampling.sock
+#
+# or `--port 8765` to listen on localhost, then talk to it with
+# `ProbabilityClient`.
+#
+# The protocol is one JSON object per line. Every request carries an
+# "id" that its response echoes, so clients can send many requests
+# without waiting and responses stream back as soon as they are ready
+# (not necessarily in order):
+#
+#   {"id": 1, "op": "register", "unitary": {"real": [...], "imag": [...]}}
+#   -> {"id": 1, "unitary": "<digest>"}
+#
+#   {"id": 2, "op": "probability", "unitary": "<digest>",
+#    "photons_in": [1, 1, 0], "photons_out": [0, 1, 1]}
+#   -> {"id": 2, "probability": 0.123}
+#
+# and {"id": ..., "error": "<message>"} if a request fails.
+
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import numbers
+
+import numpy as np
+
+import bosonsampling as bs
+
+
+def _configuration(photons, num_modes):
+    """Validate a photon configuration received from a client.
+
+    Args:
+        photons ([int]):
+            The photon count of every mode
+        num_modes (int):
+            The number of modes of the unitary matrix
+
+    Raises:
+        ValueError:
+            If the configuration is not a list of one non-negative
+            integer per mode, a ValueError is raised.
+
+    Returns:
+        (int): The configuration as a tuple of integers
+    """
+
+    if not isinstance(photons, (list, tuple)) or len(photons) != num_modes:
+        raise ValueError("Configurations do not match the number of "
+                         "modes!")
+    if not all(isinstance(count, numbers.Integral) and
+               not isinstance(count, bool) and count >= 0
+               for count in photons):
+        raise ValueError("Photon counts must be non-negative integers!")
+
+    return tuple(int(count) for count in photons)
+
+
+class ProbabilityServer:
+    """Holds registered unitary matrices in memory and answers output
+    probability requests, coalescing concurrent requests for the same
+    (unitary, photons_in) pair into one `batch_output_probability` call.
+
+    The first request for a pair opens a batch that collects every
+    request arriving within `window` seconds (or until `max_batch`
+    requests), which is then evaluated on a single worker thread so the
+    event loop stays responsive. Requests are validated before joining
+    a batch, and if a batch still fails its requests are evaluated one
+    by one, so an error only reaches the request that caused it.
+
+    Args:
+        window (float, optional):
+            The time in seconds a batch waits for more requests.
+            Defaults to 0.002.
+        max_batch (int, optional):
+            The number of requests that closes a batch early.
+            Defaults to 4096.
+        backend (str, optional):
+            The name of the permanent backend (or "auto"). Defaults to
+            the backend selected with `bs.set_permanent_backend`.
+        cache (bs.ProbabilityCache, optional):
+            A cache shared by every client. Defaults to None (no
+            caching).
+
+    Attributes:
+        batches (int):
+            The number of batches evaluated
+        requests (int):
+            The number of probability requests answered
+    """
+
+    def __init__(self, window=0.002, max_batch=4096, backend=None,
+                 cache=None):
+        self.window = window
+        self.max_batch = max_batch
+        self.backend = backend
+        self.cache = cache
+        self.batches = 0
+        self.requests = 0
+        self._unitaries = {}
+        self._pending = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def register(self, unitary_mat):
+        """Hold a unitary matrix in memory for later requests.
+
+        Args:
+            unitary_mat (np.array):
+                A unitary matrix describing an interferometer
+
+        Raises:
+            ValueError:
+                If the matrix is not square, a ValueError is raised.
+
+        Returns:
+            str: The `bs.unitary_digest` identifying the matrix
+        """
+
+        unitary_mat = np.asarray(unitary_mat, dtype=np.cdouble)
+        if unitary_mat.ndim != 2 or (unitary_mat.shape[0] !=
+                                     unitary_mat.shape[1]):
+            raise ValueError("Unitary matrices must be square!")
+        digest = bs.unitary_digest(unitary_mat)
+        self._unitaries[digest] = unitary_mat
+
+        return digest
+
+    async def probability(self, digest, photons_in, photons_out):
+        """Calculate the probability of an output configuration on a
+        registered unitary matrix, as part of a batch.
+
+        Args:
+            digest (str):
+                The digest returned by `register`
+            photons_in ([int]):
+                The input photon configuration
+            photons_out ([int]):
+                The output photon configuration
+
+        Raises:
+            ValueError:
+                If the unitary matrix is not registered or the
+                configurations do not match it, a ValueError is raised.
+
+        Returns:
+            float: The output probability
+        """
+
+        unitary_mat = self._unitaries.get(digest)
+        if unitary_mat is None:
+            raise ValueError("Unitary matrix is not registered!")
+        photons_in = _configuration(photons_in, unitary_mat.shape[0])
+        photons_out = _configuration(photons_out, unitary_mat.shape[0])
+        if sum(photons_in) != sum(photons_out):
+            raise ValueError("Number of photons inputted is not equal "
+                             "to number outputted!")
+
+        loop = asyncio.get_running_loop()
+        key = (digest, photons_in)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            loop.call_later(self.window, self._flush, key, batch)
+
+        future = loop.create_future()
+        batch.append((photons_out, future))
+        if len(batch) >= self.max_batch:
+            self._flush(key, batch)
+
+        return await future
+
+    def _flush(self, key, batch):
+        """Close a batch and evaluate it on the worker thread."""
+
+        if self._pending.get(key) is not batch:
+            # Already closed early by `max_batch`
+            return
+        del self._pending[key]
+        asyncio.ensure_future(self._evaluate(key, batch))
+
+    async def _evaluate(self, key, batch):
+        """Evaluate a closed batch and resolve its requests. Requests
+        left unresolved by an unexpected error receive that error (or
+        are cancelled if the evaluation is), so no client waits
+        forever."""
+
+        try:
+            await self._evaluate_requests(key, batch)
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+
+    async def _evaluate_requests(self, key, batch):
+        """Evaluate a closed batch, falling back to one request at a
+        time if the batch fails."""
+
+        digest, photons_in = key
+        photons_out = np.array([request[0] for request in batch],
+                               dtype=np.intp)
+        loop = asyncio.get_running_loop()
+
+        try:
+            probabilities = await loop.run_in_executor(
+                self._executor, bs.batch_output_probability, photons_in,
+                photons_out, self._unitaries[digest], self.backend, None,
+                self.cache)
+        except Exception:
+            # Evaluate the requests one by one so only the failing ones
+            # receive the error
+            for request, future in batch:
+                try:
+                    probability = await loop.run_in_executor(
+                        self._executor, bs.batch_output_probability,
+                        photons_in, np.array([request], dtype=np.intp),
+                        self._unitaries[digest], self.backend, None,
+                        self.cache)
+                except Exception as error:
+                    if not future.done():
+                        future.set_exception(error)
+                    continue
+                self.requests += 1
+                if not future.done():
+                    future.set_result(float(probability[0]))
+            self.batches += len(batch)
+            return
+
+        self.batches += 1
+        self.requests += len(batch)
+        for (_, future), probability in zip(batch, probabilities):
+            if not future.done():
+                future.set_result(float(probability))
+
+    async def _respond(self, request, writer, lock):
+        """Answer a single request and write its response line."""
+
+        response = {"id": request.get("id")}
+        try:
+            if request.get("op") == "register":
+                unitary = request["unitary"]
+                response["unitary"] = self.register(
+                    np.array(unitary["real"]) + 1j * np.array(unitary["imag"]))
+            elif request.get("op") == "probability":
+                response["probability"] = await self.probability(
+                    request["unitary"], request["photons_in"],
+                    request["photons_out"])
+            else:
+                raise ValueError("Unknown operation!")
+        except Exception as error:
+            response["error"] = str(error)
+
+        async with lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    async def _handle(self, reader, writer):
+        """Serve one client connection until it closes."""
+
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            async for line in reader:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Requests must be JSON objects!")
+                except ValueError as error:
+                    async with lock:
+                        writer.write((json.dumps({"id": None,
+                                                  "error": str(error)}) +
+                                      "\n").encode())
+                        await writer.drain()
+                    continue
+                task = asyncio.ensure_future(self._respond(request, writer,
+                                                           lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def serve_unix(self, path):
+        """Start listening on a Unix domain socket.
+
+        Args:
+            path (str):
+                The path of the socket file
+
+        Returns:
+            asyncio.AbstractServer: The listening server
+        """
+
+        return await asyncio.start_unix_server(self._handle, path)
+
+    async def serve_tcp(self, host="127.0.0.1", port=8765):
+        """Start listening on a TCP port.
+
+        Args:
+            host (str, optional):
+                The address to bind. Defaults to "127.0.0.1" (local
+                connections only).
+            port (int, optional):
+                The port to bind. Defaults to 8765.
+
+        Returns:
+            asyncio.AbstractServer: The listening server
+        """
+
+        return await asyncio.start_server(self._handle, host, port)
+
+    def close(self):
+        """Stop the worker thread."""
+
+        self._executor.shutdown()
+
+
+class ProbabilityClient:
+    """An asyncio client of a `ProbabilityServer`. Requests can be
+    issued concurrently over one connection (e.g. with
+    `asyncio.gather`), each is resolved as soon as its response
+    arrives.
+    """
+
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+        self._responses = {}
+        self._ids = itertools.count()
+        self._listener = None
+
+    async def connect(self, path=None, host="127.0.0.1", port=8765):
+        """Connect to a server on a Unix domain socket or TCP port.
+
+        Args:
+            path (str, optional):
+                The path of the server socket file. Defaults to None
+                (connect over TCP).
+            host (str, optional):
+                The server address. Defaults to "127.0.0.1".
+            port (int, optional):
+                The server port. Defaults to 8765.
+        """
+
+        if path is not None:
+            self._reader, self._writer = await asyncio.open_unix_connection(
+                path)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(
+                host, port)
+        self._listener = asyncio.ensure_future(self._listen())
+
+    async def _listen(self):
+        """Dispatch response lines to the requests waiting for them."""
+
+        async for line in self._reader:
+            response = json.loads(line)
+            future = self._responses.pop(response.get("id"), None)
+            if future is None or future.done():
+                continue
+            if "error" in response:
+                future.set_exception(ValueError(response["error"]))
+            else:
+                future.set_result(response)
+
+        for future in self._responses.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Server closed the "
+                                                     "connection!"))
+
+    async def _request(self, request):
+        request["id"] = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._responses[request["id"]] = future
+        self._writer.write((json.dumps(request) + "\n").encode())
+        await self._writer.drain()
+
+        return await future
+
+    async def register(self, unitary_mat):
+        """Register a unitary matrix with the server.
+
+        Args:
+            unitary_mat (np.array):
+                A unitary matrix describing an interferometer
+
+        Returns:
+            str: The digest identifying the matrix in later requests
+        """
+
+        unitary_mat = np.asarray(unitary_mat, dtype=np.cdouble)
+        response = await self._request({
+            "op": "register",
+            "unitary": {"real": unitary_mat.real.tolist(),
+                        "imag": unitary_mat.imag.tolist()}})
+
+        return response["unitary"]
+
+    async def probability(self, digest, photons_in, photons_out):
+        """Request the probability of an output configuration.
+
+        Args:
+            digest (str):
+                The digest returned by `register`
+            photons_in ([int]):
+                The input photon configuration
+            photons_out ([int]):
+                The output photon configuration
+
+        Raises:
+            ValueError:
+                If the server rejects the request, a ValueError is
+                raised.
+
+        Returns:
+            float: The output probability
+        """
+
+        response = await self._request({
+            "op": "probability", "unitary": digest,
+            "photons_in": [int(count) for count in photons_in],
+            "photons_out": [int(count) for count in photons_out]})
+
+        return response["probability"]
+
+    async def close(self):
+        """Close the connection."""
+
+        self._writer.close()
+        await self._writer.wait_closed()
+        if self._listener is not None:
+            await self._listener
+
+
+async def _serve(args):
+    cache = None
+    if args.cache is not None:
+        cache = bs.ProbabilityCache(path=args.cache)
+    server = ProbabilityServer(window=args.window, max_batch=args.max_batch,
+                               backend=args.backend, cache=cache)
+    if args.socket is not None:
+        listener = await server.serve_unix(args.socket)
+    else:
+        listener = await server.serve_tcp(args.host, args.port)
+
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+        if cache is not None:
+            cache.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve boson sampling output probabilities locally.")
+    parser.add_argument("--socket", default=None,
+                        help="Unix domain socket path to listen on")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on without --socket")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="port to listen on without --socket")
+    parser.add_argument("--window", type=float, default=0.002,
+                        help="seconds a batch waits for more requests")
+    parser.add_argument("--max-batch", type=int, default=4096,
+                        help="number of requests that closes a batch")
+    parser.add_argument("--backend", default=None,
+                        help="permanent backend")
+    parser.add_argument("--cache", default=None,
+                        help="SQLite file probabilities are cached in")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
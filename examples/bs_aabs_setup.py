@@ -28,12 +28,10 @@
 # increase in size
 
 import bosonsampling as bs
-from sympy.utilities.iterables import multiset_permutations
-from strawberryfields.utils import random_interferometer
 import numpy as np
 
 # Generate large random interferometer
-random_interferometer = random_interferometer(40)
+random_interferometer = bs.random_unitaries(40)[0]
 
 # two single photon fock states are created for input. Note
 # how the modes selected are right next to each other, as part of
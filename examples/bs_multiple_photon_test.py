@@ -21,11 +21,10 @@
 
 
 import bosonsampling as bs
-from strawberryfields.utils import random_interferometer
 
 # Generate Random (4 x 4) unitary to represent an interferometer
 # with 4 mode I/O
-random_interferometer = random_interferometer(4)
+random_interferometer = bs.random_unitaries(4)[0]
 
 # Input configuration, multiple photons in different modes, with
 # some modes containing more than one photon
@@ -27,7 +27,6 @@
 import strawberryfields as sf
 from strawberryfields.ops import *
 from strawberryfields.utils import random_interferometer
-from sympy.utilities.iterables import multiset_permutations
 import numpy as np
 
 import bosonsampling as bs
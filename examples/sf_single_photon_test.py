@@ -29,7 +29,6 @@
 import strawberryfields as sf
 from strawberryfields.ops import *
 from strawberryfields.utils import random_interferometer
-from sympy.utilities.iterables import multiset_permutations
 import numpy as np
 
 import bosonsampling as bs